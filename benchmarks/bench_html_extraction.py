@@ -0,0 +1,92 @@
+"""
+Benchmark for the HTML extraction hot path
+------------------------------------------
+
+Compares the old way of reading a product page (a pure-Python parse followed by
+repeated find_all() scans and soup.select() calls for every selector table) with
+the single-pass PageIndex, using html.parser and lxml (when installed). It also
+checks that both produce the same image candidates.
+
+Usage:
+    python benchmarks/bench_html_extraction.py [page.html ...]
+
+Without arguments every page in benchmarks/fixtures/pages is used.
+"""
+import glob
+import os
+import statistics
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shopify_ad_tool_working as tool
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pages')
+PRODUCT_URL = 'http://localhost/products/benchmark'
+
+class SoupSelector:
+    """
+    Answers select_images() with full-tree soup.select() scans, like the code before PageIndex
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    def select_images(self, selector):
+        return self.soup.select(selector)
+
+def legacy_extract(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    for _ in range(4):
+        soup.find_all('script')
+    for _ in range(3):
+        soup.find_all('script', type='application/ld+json')
+    soup.find('meta', property='og:image')
+    soup.find('meta', property='og:title')
+    soup.find('meta', property='og:price:amount')
+    for selector in tool.SHOPIFY_GALLERY_SELECTORS + tool.GENERIC_IMAGE_SELECTORS:
+        soup.select(selector)
+    return list(tool.iter_generic_image_candidates(SoupSelector(soup), PRODUCT_URL))
+
+def index_extract(content, parser):
+    page = tool.PageIndex.from_html(content, parser)
+    for selector in tool.SHOPIFY_GALLERY_SELECTORS + tool.GENERIC_IMAGE_SELECTORS:
+        for _ in page.select_images(selector):
+            pass
+    return list(tool.iter_generic_image_candidates(page, PRODUCT_URL))
+
+def timed(function, *args, repeat=5):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+def main(paths):
+    parsers = ['html.parser']
+    try:
+        import lxml
+        parsers.append('lxml')
+    except ImportError:
+        print("lxml is not installed, only html.parser is benchmarked")
+
+    print(f"{'page':<20}{'size':>10}{'legacy':>12}" + ''.join(f"{'index/' + p:>20}" for p in parsers))
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        legacy_time, legacy_candidates = timed(legacy_extract, content)
+        row = f"{os.path.basename(path):<20}{len(content) // 1024:>8}KB{legacy_time * 1000:>10.1f}ms"
+        for parser in parsers:
+            index_time, candidates = timed(index_extract, content, parser)
+            if candidates != legacy_candidates:
+                print(f"Candidate mismatch for {path} with {parser}:\n  legacy: {legacy_candidates}\n  index:  {candidates}")
+            row += f"{index_time * 1000:>10.1f}ms ({legacy_time / index_time:.1f}x)"
+        print(row)
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(PAGES_DIR, '*.html'))))
@@ -0,0 +1,104 @@
+"""
+Benchmark and decision check for image quality scoring
+------------------------------------------------------
+
+Compares the original full-resolution quality check (std dev, histogram entropy and
+pixelation over every pixel) with score_image, which works on a reduced proxy and a
+grid of full-resolution tiles. Every image must get the same accept/reject decision
+from both; a mismatch is printed and makes the script exit with status 1.
+
+benchmarks/fixtures/quality holds images chosen to sit near each threshold: photos in
+several modes and sizes, a blurred photo, noise, a smooth gradient, a flat graphic,
+blank and near-blank images, a too-small image, and nearest-neighbour upscales at and
+off the 4x grid the pixelation check reduces to.
+
+Usage:
+    python benchmarks/bench_image_quality.py [image ...]
+
+Without arguments every image in benchmarks/fixtures/images and
+benchmarks/fixtures/quality is used.
+"""
+import glob
+import io
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shopify_ad_tool_working as tool
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def legacy_check(image_data, min_width=200, min_height=200, max_compression_ratio=0.1):
+    """
+    The quality check before score_image, returning its rejection reason or None
+    """
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        width, height = img.size
+        if width < min_width or height < min_height:
+            return 'too_small'
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img_array = np.array(img)
+    except Exception:
+        return 'decode_error'
+
+    if np.std(img_array) < 10:
+        return 'blank'
+
+    histogram = img.histogram()
+    histogram_length = sum(histogram)
+    samples_probability = [hist_value / histogram_length for hist_value in histogram]
+    entropy = -sum([p * np.log2(p) for p in samples_probability if p != 0])
+    if entropy < max_compression_ratio * np.log2(256):
+        return 'low_quality'
+
+    small = img.resize((width // 4, height // 4), Image.Resampling.LANCZOS)
+    large = small.resize((width, height), Image.Resampling.NEAREST)
+    diff = np.array(img) - np.array(large)
+    if np.mean(np.abs(diff)) < 5:
+        return 'pixelated'
+    return None
+
+def timed(function, *args, repeat=3):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+def main(paths):
+    mismatches = 0
+    print(f"{'image':<28}{'size':>11}{'legacy':>24}{'score_image':>24}")
+    for path in paths:
+        with open(path, 'rb') as f:
+            image_data = f.read()
+        try:
+            size = '{}x{}'.format(*Image.open(io.BytesIO(image_data)).size)
+        except Exception:
+            size = '?'
+
+        legacy_time, legacy_reason = timed(legacy_check, image_data)
+        score_time, quality = timed(tool.score_image, image_data)
+        row = (f"{os.path.basename(path):<28}{size:>11}"
+               f"{str(legacy_reason or 'ok'):>13}{legacy_time * 1000:>9.1f}ms"
+               f"{str(quality.reason or 'ok'):>13}{score_time * 1000:>9.1f}ms")
+        if quality.reason != legacy_reason:
+            mismatches += 1
+            row += '  MISMATCH'
+        print(row)
+
+    if mismatches:
+        print(f"{mismatches} decision(s) differ from the legacy check")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES_DIR, 'images', '*')) +
+                                glob.glob(os.path.join(FIXTURES_DIR, 'quality', '*'))))
@@ -0,0 +1,342 @@
+"""
+Benchmark suite for the extraction, image and rendering hot paths
+-----------------------------------------------------------------
+
+Replays the recorded storefront pages in benchmarks/fixtures/pages (Shopify,
+WooCommerce and a generic store) and the images in benchmarks/fixtures/images
+through a local HTTP stand-in, and times these functions separately:
+
+    extract_product_data   full page fetch + extraction + image validation, per page
+    is_valid_image         image fetch + quality scoring, per image
+    is_duplicate_image     perceptual-hash comparison against three other images
+    find_images_with_cv    with a replay browser returning a recorded page; the
+                           "dom" case reads rendered <img> elements, "contour"
+                           forces the screenshot path
+    generate_ad_creative   one creative, per ad size
+
+and these micro-benchmarks over the recorded pages themselves (no network
+involved):
+
+    harvest_script_images  image URL/data URI harvesting from the <script>
+                           bodies, per page
+    clean_image_url        normalizing every image URL in the page, per page,
+                           with the memoization cache emptied first
+
+Every benchmark runs in its own subprocess so its peak RSS is its own. For each
+one the suite reports throughput, p50/p95 latency and peak RSS, and with
+--baseline compares them against a stored run; a p50/p95 latency or peak RSS
+more than --tolerance worse than the baseline is reported as a regression and
+makes the script exit with status 1.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--iterations N] [--only NAME ...]
+        [--baseline benchmarks/baseline.json] [--tolerance 0.25] [--save-baseline PATH]
+
+Baselines are machine specific: record one with --save-baseline on the machine
+that will run the comparison.
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shopify_ad_tool_working as tool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+PAGES = {
+    '/products/organic-cotton-tee': 'shopify.html',
+    '/product/woocommerce-hoodie': 'woocommerce.html',
+    '/item/generic-sneaker': 'generic.html',
+}
+
+# The recorded pages reference many more image URLs than there are image fixtures;
+# each request path is mapped to a fixture by its name.
+IMAGE_ROUTES = [
+    (re.compile(r'/images/(?:shopify|woo|generic)-(\d+)'), lambda m: f'product-{int(m.group(1)) % 4}.jpg'),
+    (re.compile(r'/images/(?:rec|rel)-'), lambda m: 'related.jpg'),
+    (re.compile(r'/images/placeholder'), lambda m: 'placeholder.gif'),
+    (re.compile(r'/images/'), lambda m: 'icon.png'),
+]
+
+# The stand-in only speaks plain HTTP, so https:// and protocol-relative (which the
+# tool resolves to https) links to the store are served as http://
+HOST_LINK = re.compile(r'https://\{\{HOST\}\}|(?<![:\w])//\{\{HOST\}\}')
+
+CONTENT_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif'}
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the recorded pages (with {{HOST}} replaced) and images; everything else,
+    including the Shopify /products/<handle>.js endpoint, is a 404 so the HTML
+    extraction path is what gets measured
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in PAGES:
+            with open(os.path.join(FIXTURES_DIR, 'pages', PAGES[path]), 'r', encoding='utf-8') as f:
+                page = HOST_LINK.sub('http://{{HOST}}', f.read())
+                page = page.replace('{{HOST}}', self.headers['Host'])
+            return self.send_body(page.encode('utf-8'), 'text/html; charset=utf-8')
+        for pattern, filename in IMAGE_ROUTES:
+            match = pattern.match(path)
+            if match:
+                name = filename(match)
+                with open(os.path.join(FIXTURES_DIR, 'images', name), 'rb') as f:
+                    return self.send_body(f.read(), CONTENT_TYPES[os.path.splitext(name)[1]])
+        self.send_body(b'Not found', 'text/plain', 404)
+
+def start_fixture_server():
+    """
+    Starts the stand-in store on a free local port, returning (server, base_url)
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+class ReplayDriver:
+    """
+    Stands in for a Chrome WebDriver: loads pages from the fixture server and answers
+    with a recorded screenshot and rendered-image list
+    """
+
+    def __init__(self, base_url, with_dom=True):
+        self.base_url = base_url
+        self.with_dom = with_dom
+        self.current_url = 'about:blank'
+        with open(os.path.join(FIXTURES_DIR, 'screenshots', 'product.jpg'), 'rb') as f:
+            self.screenshot = f.read()
+        with open(os.path.join(FIXTURES_DIR, 'screenshots', 'product.json'), 'r', encoding='utf-8') as f:
+            self.rendered = json.loads(f.read().replace('{{HOST}}', base_url.split('//', 1)[1]))
+
+    def get(self, url):
+        tool.http_client.get(url, use_cache=False)
+        self.current_url = url
+
+    def execute_script(self, script):
+        if 'document.images' in script:
+            return self.rendered if self.with_dom else {'images': []}
+        return None
+
+    def get_screenshot_as_png(self):
+        return self.screenshot
+
+    def quit(self):
+        pass
+
+def reset_caches():
+    tool.image_store.clear()
+
+def bench_extract(base_url):
+    tool.configure_browser_pool(size=1, driver_factory=functools.partial(ReplayDriver, base_url))
+    urls = [base_url + path for path in PAGES]
+    def run(i):
+        reset_caches()
+        tool.extract_product_data(urls[i % len(urls)])
+    return run
+
+def bench_valid_image(base_url):
+    urls = [f'{base_url}/images/shopify-{i}.jpg' for i in range(4)]
+    def run(i):
+        reset_caches()
+        tool.is_valid_image(urls[i % len(urls)])
+    return run
+
+def bench_duplicate_image(base_url):
+    urls = [f'{base_url}/images/woo-{i}.jpg' for i in range(4)]
+    def run(i):
+        reset_caches()
+        tool.is_duplicate_image(urls[0], urls[1:])
+    return run
+
+def bench_cv(base_url, with_dom):
+    tool.configure_browser_pool(size=1, driver_factory=functools.partial(ReplayDriver, base_url, with_dom))
+    url = base_url + '/item/generic-sneaker'
+    def run(i):
+        reset_caches()
+        tool.find_images_with_cv(url)
+    return run
+
+def bench_render(base_url):
+    product_data = {
+        'title': 'Organic Cotton Tee', 'price': 1499.0,
+        'images': [f'{base_url}/images/shopify-{i}.jpg' for i in range(4)],
+        'product_url': base_url + '/products/organic-cotton-tee',
+    }
+    tool.add_ad_fields(product_data, product_data['product_url'])
+    output_dir = tempfile.mkdtemp(prefix='ad-bench-')
+    def run(i):
+        width, height = tool.AD_SIZES[i % len(tool.AD_SIZES)]
+        tool.generate_ad_creative(product_data, os.path.join(output_dir, f'ad_{width}x{height}.html'), width, height)
+    return run
+
+def load_pages():
+    """
+    Returns the HTML of each recorded page
+    """
+    pages = []
+    for filename in sorted(PAGES.values()):
+        with open(os.path.join(FIXTURES_DIR, 'pages', filename), 'r', encoding='utf-8') as f:
+            pages.append(f.read().replace('{{HOST}}', 'store.example.com'))
+    return pages
+
+def bench_harvest_scripts(base_url):
+    corpus = [tool.PageIndex.from_html(page).scripts for page in load_pages()]
+    def run(i):
+        tool.harvest_script_images(corpus[i % len(corpus)])
+    return run
+
+def bench_clean_urls(base_url):
+    corpus = [tool.SCRIPT_IMAGE_URL.findall(page) for page in load_pages()]
+    def run(i):
+        tool.clean_image_url.cache_clear()
+        for url in corpus[i % len(corpus)]:
+            tool.clean_image_url(url)
+    return run
+
+BENCHMARKS = {
+    'extract_product_data': bench_extract,
+    'is_valid_image': bench_valid_image,
+    'is_duplicate_image': bench_duplicate_image,
+    'find_images_with_cv[dom]': lambda base_url: bench_cv(base_url, True),
+    'find_images_with_cv[contour]': lambda base_url: bench_cv(base_url, False),
+    'generate_ad_creative': bench_render,
+    'harvest_script_images': bench_harvest_scripts,
+    'clean_image_url': bench_clean_urls,
+}
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def run_one(name, iterations, warmup=2):
+    """
+    Runs one benchmark in this process and returns its measurements
+    """
+    server, base_url = start_fixture_server()
+    run = BENCHMARKS[name](base_url)
+
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        for i in range(warmup):
+            run(i)
+        timings = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            call_started = time.perf_counter()
+            run(i)
+            timings.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        server.shutdown()
+
+    return {
+        'iterations': iterations,
+        'throughput': iterations / elapsed,
+        'p50_ms': statistics.median(timings) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_isolated(name, iterations):
+    """
+    Runs one benchmark in a fresh interpreter so peak RSS is measured per benchmark
+    """
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name,
+                             '--iterations', str(iterations)],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def compare(results, baseline, tolerance):
+    """
+    Returns {name: [regressed metric, ...]} for results worse than baseline by more than tolerance
+    """
+    regressions = {}
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        worse = [metric for metric in ('p50_ms', 'p95_ms', 'peak_rss_mb')
+                 if metric in reference and result[metric] > reference[metric] * (1 + tolerance)]
+        if worse:
+            regressions[name] = worse
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ad generator hot paths against recorded fixtures.')
+    parser.add_argument('--iterations', type=int, default=30, help='Timed calls per benchmark')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Benchmarks to run (default: all)')
+    parser.add_argument('--baseline', help=f'Baseline JSON to compare against (e.g. {os.path.relpath(DEFAULT_BASELINE)})')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown/growth over the baseline before a regression is reported')
+    parser.add_argument('--save-baseline', help='Write the results to this baseline JSON')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        print(json.dumps(run_one(args.worker, args.iterations)))
+        return 0
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'benchmark':<30}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'RSS MB':>10}{'vs base p50':>14}")
+    for name in args.only or list(BENCHMARKS):
+        result = results[name] = run_isolated(name, args.iterations)
+        reference = baseline.get(name, {}).get('p50_ms')
+        change = f"{(result['p50_ms'] / reference - 1) * 100:+.0f}%" if reference else '-'
+        print(f"{name:<30}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['peak_rss_mb']:>10.1f}{change:>14}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nBaseline written to {args.save_baseline}")
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, metrics in regressions.items():
+        print(f"REGRESSION {name}: {', '.join(metrics)} more than {args.tolerance:.0%} worse than baseline")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,148 +15,2284 @@ Main features:
 Author: Kartikye Kashyap
 """
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 import json
 import os
-from urllib.parse import urlparse
-from jinja2 import Environment, FileSystemLoader
+from urllib.parse import urlparse, urlsplit, urlunsplit
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import re
 import time
-from datetime import datetime
-from PIL import Image
+from datetime import datetime, timezone
+import email.utils
+import heapq
+import itertools
+from PIL import Image, ImageOps, features
 import io
 import numpy as np
 from urllib.request import urlopen
 import random
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import JavascriptException, TimeoutException, WebDriverException
 import cv2
 import base64
 from io import BytesIO
+import threading
+import hashlib
+import atexit
+import contextlib
+import codecs
+import struct
+import multiprocessing
+import argparse
+import tarfile
+import zipfile
+import asyncio
+import functools
+import requests.adapters
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
+class Metrics:
+    """
+    Thread-safe per-stage timings and counters for a run.
+
+    Stages are timed with `with metrics.span('fetch.page'):` and recorded as a call
+    count, error count, total and maximum duration; counters are incremented with
+    metrics.incr('bytes_fetched', n, kind='image'). Both can be exported as JSON or
+    in the Prometheus text format.
+    """
+
+    def __init__(self, prefix='ad_tool'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+            self._counters = {}
+
+    def observe(self, stage, seconds, error=False):
+        with self._lock:
+            span = self._spans.get(stage)
+            if span is None:
+                span = self._spans[stage] = {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            span['count'] += 1
+            span['errors'] += int(error)
+            span['total_seconds'] += seconds
+            span['max_seconds'] = max(span['max_seconds'], seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, error)
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        """
+        Returns {'spans': {stage: {...}}, 'counters': [{'name', 'labels', 'value'}, ...]}
+        """
+        with self._lock:
+            spans = {stage: dict(span) for stage, span in sorted(self._spans.items())}
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {'spans': spans, 'counters': counters}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        stage_metric = f'{self.prefix}_stage_seconds'
+        lines = [f'# TYPE {stage_metric} summary']
+        for stage, span in snapshot['spans'].items():
+            lines.append(f'{stage_metric}_sum{{stage="{stage}"}} {span["total_seconds"]:.6f}')
+            lines.append(f'{stage_metric}_count{{stage="{stage}"}} {span["count"]}')
+        for field, kind in (('max_seconds', 'gauge'), ('errors', 'counter')):
+            name = f'{self.prefix}_stage_{field}' + ('_total' if kind == 'counter' else '')
+            lines.append(f'# TYPE {name} {kind}')
+            for stage, span in snapshot['spans'].items():
+                lines.append(f'{name}{{stage="{stage}"}} {span[field]}')
+
+        declared = set()
+        for counter in snapshot['counters']:
+            name = f"{self.prefix}_{counter['name']}_total"
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} counter')
+            labels = ','.join(f'{key}="{value}"' for key, value in sorted(counter['labels'].items()))
+            lines.append(f"{name}{{{labels}}} {counter['value']}" if labels else f"{name} {counter['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the metrics to path, in Prometheus text format if it ends in .prom or .txt, else JSON
+        """
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+metrics = Metrics()
+
+DEBUG_LOGGING = bool(os.environ.get('AD_TOOL_DEBUG'))
+DEBUG_DUMP_DIR = None
+
+def enable_debug(dump_dir=None):
+    """
+    Turns on debug logging and, if dump_dir is given, saving every downloaded product page there
+    """
+    global DEBUG_LOGGING, DEBUG_DUMP_DIR
+    DEBUG_LOGGING = True
+    DEBUG_DUMP_DIR = dump_dir
+    if dump_dir:
+        os.makedirs(dump_dir, exist_ok=True)
+
+def debug(message):
+    if DEBUG_LOGGING:
+        print(f"Debug - {message}")
+
+def dump_response(product_url, content):
+    """
+    Saves a downloaded page to DEBUG_DUMP_DIR (when enabled) for inspecting extraction problems
+    """
+    if not DEBUG_DUMP_DIR:
+        return
+    name = urlparse(product_url).path.rstrip('/').split('/')[-1] or 'index'
+    digest = hashlib.sha256(product_url.encode('utf-8')).hexdigest()[:8]
+    with open(os.path.join(DEBUG_DUMP_DIR, f'{name}-{digest}.html'), 'w', encoding='utf-8') as f:
+        f.write(content)
+
+AJIO_IMAGE_SIZE = re.compile(r'-\d+Wx\d+H-')
+LOW_QUALITY_WORDS = re.compile(r'(small|thumb|tiny|mobile|low|min)', re.I)
+SIZE_QUERY_PARAMS = re.compile(r'[?&](?:(?:w|width|h|height)=\d+|size=\d+x\d+|quality=\d+)')
+
+@functools.lru_cache(maxsize=8192)
 def clean_image_url(url):
     """
-    Cleans image URLs to get highest quality version
+    Cleans image URLs to get highest quality version
+    
+    The same URLs are cleaned over and over (for every extractor, validation and
+    dedup pass), so results are memoized.
+    """
+    try:
+        if 'assets.ajio.com' in url:
+            url = AJIO_IMAGE_SIZE.sub('-1200Wx1500H-', url)
+        
+        url = LOW_QUALITY_WORDS.sub('large', url)
+        url = SIZE_QUERY_PARAMS.sub('', url)
+        
+        if '?' in url:
+            url = url.split('?')[0]
+            
+        return url
+    except:
+        return url
+
+# Both patterns start with a literal, which lets the regex engine skip ahead to
+# candidate positions; a single alternation of the two scans several times slower
+SCRIPT_IMAGE_URL = re.compile(r'https?://[^\s<>"\']+?(?:jpg|jpeg|png|webp|gif)')
+SCRIPT_DATA_URI = re.compile(r'data:image/[^;]+;base64,[a-zA-Z0-9+/]+=*')
+PRODUCT_SCRIPT_IMAGE_URL = re.compile(r'https?://[^\s<>"\']+?(?:jpg|jpeg|png|webp)')
+
+def harvest_script_images(scripts):
+    """
+    Returns (urls, data_uris), the image URLs and base64 image data URIs embedded in
+    script bodies, each in order of first appearance
+    
+    Each script is scanned once for URLs, and for data URIs only if it contains any.
+    Repeats (the same URL with another scheme or query string, or the same data URI)
+    are dropped as they are found.
+    """
+    urls, data_uris, seen = [], [], set()
+    for script in scripts:
+        for url in SCRIPT_IMAGE_URL.findall(script):
+            key = _image_key(url)
+            if key not in seen:
+                seen.add(key)
+                urls.append(url)
+        if 'data:image/' in script:
+            for data_uri in SCRIPT_DATA_URI.findall(script):
+                if data_uri not in seen:
+                    seen.add(data_uri)
+                    data_uris.append(data_uri)
+    return urls, data_uris
+
+class DiskCache:
+    """
+    Optional persistent cache for page HTML and image bytes.
+
+    Bodies are stored content-addressed (by SHA-256) under `root/objects`, so the
+    same image served under several URLs is kept once. A JSON index maps each URL to
+    its body digest and the ETag/Last-Modified validators it was served with. A body
+    whose download was stopped early by the caller is stored too, marked partial, and
+    only served to callers that read bodies incrementally. Entries younger than the
+    TTL of their content type are served without touching the network; older ones are
+    revalidated with a conditional request and reused on 304. The least recently used
+    entries are evicted once the stored bodies exceed `max_bytes`; the total size and
+    the number of URLs referencing each body are kept up to date as entries come and
+    go, so this costs no scan of the index.
+    """
+
+    DEFAULT_TTLS = {'page': 6 * 60 * 60, 'image': 7 * 24 * 60 * 60}
+
+    def __init__(self, root='.cache', max_bytes=2 * 1024 ** 3, ttls=None, flush_every=50):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        self.flush_every = flush_every
+        self._index_path = os.path.join(root, 'index.json')
+        self._lock = threading.RLock()
+        self._pending_writes = 0
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        self._refs = {}
+        self._sizes = {}
+        self._total = 0
+        for entry in self._index.values():
+            self._add_ref(entry)
+
+    def _add_ref(self, entry):
+        digest = entry['digest']
+        if digest not in self._refs:
+            self._refs[digest] = 0
+            self._sizes[digest] = entry['size']
+            self._total += entry['size']
+        self._refs[digest] += 1
+
+    def _drop_ref(self, entry):
+        # Deletes the body once no URL references it any more
+        digest = entry['digest']
+        self._refs[digest] -= 1
+        if self._refs[digest] == 0:
+            del self._refs[digest]
+            self._total -= self._sizes.pop(digest)
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        Returns the index entry for a URL if its body is still on disk
+        """
+        with self._lock:
+            entry = self._index.get(url)
+            if entry and os.path.exists(self._object_path(entry['digest'])):
+                return entry
+            return None
+
+    def is_fresh(self, entry):
+        ttl = self.ttls.get(entry.get('kind'), 0)
+        return time.time() - entry['stored_at'] < ttl
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def read(self, entry):
+        """
+        Returns the stored body of an entry, or None if it was evicted in the meantime
+        """
+        try:
+            with open(self._object_path(entry['digest']), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            entry['accessed_at'] = time.time()
+        return data
+
+    def store(self, url, kind, data, headers=None, encoding=None, partial=False):
+        """
+        Stores a response body and its validators, returning the new index entry
+        
+        Args:
+            partial: The body is only the start of the resource (see HttpClient.get)
+        """
+        headers = headers or {}
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        entry = {
+            'digest': digest,
+            'size': len(data),
+            'kind': kind,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_type': headers.get('Content-Type'),
+            'encoding': encoding,
+            'partial': partial,
+            'stored_at': now,
+            'accessed_at': now
+        }
+        with self._lock:
+            self._add_ref(entry)
+            previous = self._index.get(url)
+            self._index[url] = entry
+            if previous is not None:
+                self._drop_ref(previous)
+            self._evict()
+            self._note_write()
+        return entry
+
+    def revalidated(self, entry):
+        """
+        Marks an entry as confirmed fresh by a 304 response
+        """
+        with self._lock:
+            entry['stored_at'] = entry['accessed_at'] = time.time()
+            self._note_write()
+
+    def _evict(self):
+        if self._total <= self.max_bytes:
+            return
+        # Evict down to 90% of the limit, so the index is not sorted again on every store
+        target = self.max_bytes * 0.9
+        for url, entry in sorted(self._index.items(), key=lambda item: item[1]['accessed_at']):
+            if self._total <= target:
+                break
+            del self._index[url]
+            self._drop_ref(entry)
+
+    def _note_write(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the index to disk
+        """
+        with self._lock:
+            tmp_path = f"{self._index_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self._index_path)
+            self._pending_writes = 0
+
+disk_cache = None
+
+def enable_disk_cache(root='.cache', max_bytes=2 * 1024 ** 3, ttls=None):
+    """
+    Turns on the persistent page/image cache for the rest of the run
+    
+    Args:
+        root: Directory holding the cache index and stored bodies
+        max_bytes: Maximum total size of stored bodies before eviction
+        ttls: Optional overrides of the per content type TTLs in seconds, e.g. {'page': 3600}
+    """
+    global disk_cache
+    disk_cache = DiskCache(root, max_bytes=max_bytes, ttls=ttls)
+    atexit.register(disk_cache.flush)
+    return disk_cache
+
+def _cached_response(url, data, entry):
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    response._content = data
+    response.truncated = bool(entry.get('partial'))
+    response.encoding = entry.get('encoding')
+    if entry.get('content_type'):
+        response.headers['Content-Type'] = entry['content_type']
+    if entry.get('etag'):
+        response.headers['ETag'] = entry['etag']
+    if entry.get('last_modified'):
+        response.headers['Last-Modified'] = entry['last_modified']
+    response.from_cache = True
+    return response
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    """
+    Raised when a response body exceeds the size limit of the request
+    """
+
+def parse_retry_after(value):
+    """
+    Returns the delay in seconds requested by a Retry-After header (delta-seconds or
+    an HTTP date), or None if it is missing or malformed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class HostState:
+    """
+    Scheduling state of one host: its token bucket, concurrency limit and waiting requests
+    """
+
+    def __init__(self, host, rate, burst, concurrency):
+        self.host = host
+        # Refill rate of the token bucket, None while the host is not rate limited
+        self.rate = rate
+        self.rate_step = 0.0
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.limit = float(concurrency)
+        self.active = 0
+        self.blocked_until = 0.0
+        self.throttles = 0
+        self.waiting = []
+        # Start times of the requests sent in the last second
+        self.recent = deque()
+
+class HostScheduler:
+    """
+    Per-host politeness scheduler for HttpClient.
+
+    Every request to a host takes one of the host's concurrency slots and, once the
+    host is rate limited, a token from its token bucket (bursts up to `burst`). Both
+    adapt AIMD-style: each successful response adds 1/limit slots (about one slot per
+    round of requests) and 1% of the throttled rate to the refill rate, and each 429
+    or 503 halves the slots and sets the refill rate to half the rate requests were
+    actually being sent at. A host that never pushes back is only held to `rate`
+    (unlimited by default), while one that does settles just below its own limit. A
+    429/503 also pauses the whole host, for the Retry-After delay if the response
+    gives one, otherwise for an exponential backoff. Requests waiting for the same
+    host are served in priority order, pages before images, so product pages (which
+    produce more work) are not stuck behind a gallery of image downloads.
+    """
+
+    PRIORITIES = {'page': 0, 'image': 1}
+    THROTTLE_STATUSES = {429, 503}
+    MIN_RATE = 0.5
+
+    def __init__(self, rate=None, burst=20, initial_concurrency=4, max_concurrency=16,
+                 cooldown=1.0, max_cooldown=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.initial_concurrency = min(initial_concurrency, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._hosts = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _next_delay(self, state, now):
+        # Seconds until state may start another request (ignoring the concurrency limit)
+        delay = state.blocked_until - now
+        if state.rate is not None:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            delay = max(delay, (1 - state.tokens) / state.rate)
+        return max(delay, 0)
+
+    def acquire(self, url, kind='page'):
+        """
+        Blocks until a request to url may be sent, returning the HostState to release
+        """
+        host = urlparse(url).netloc
+        ticket = (self.PRIORITIES.get(kind, len(self.PRIORITIES)), next(self._sequence))
+        started = time.monotonic()
+        with self._condition:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = HostState(host, self.rate, self.burst, self.initial_concurrency)
+            heapq.heappush(state.waiting, ticket)
+            while True:
+                timeout = None
+                if state.waiting[0] == ticket and state.active < int(state.limit):
+                    now = time.monotonic()
+                    timeout = self._next_delay(state, now)
+                    if timeout <= 0:
+                        heapq.heappop(state.waiting)
+                        state.tokens -= 1
+                        state.active += 1
+                        state.recent.append(now)
+                        while now - state.recent[0] > 1:
+                            state.recent.popleft()
+                        # The next waiting request may be able to start as well
+                        self._condition.notify_all()
+                        break
+                self._condition.wait(timeout)
+        metrics.observe(f'http.wait.{kind}', time.monotonic() - started)
+        return state
+
+    def release(self, state, status=None, retry_after=None):
+        """
+        Frees a request slot, adapting the host's limits to the response status
+        
+        Args:
+            status: HTTP status of the response, or None if no response was received
+            retry_after: Delay in seconds from the response's Retry-After header
+        """
+        with self._condition:
+            state.active -= 1
+            if status in self.THROTTLE_STATUSES:
+                metrics.incr('http_throttled', status=str(status))
+                now = time.monotonic()
+                # Requests already in flight when the host was paused come back throttled
+                # too; only the first of them lowers the limits
+                if now >= state.blocked_until:
+                    window = min(1.0, now - state.blocked_until)
+                    sent_rate = len(state.recent) / max(window, 0.1)
+                    if state.rate is not None:
+                        sent_rate = min(state.rate, sent_rate)
+                    state.limit = max(1.0, state.limit / 2)
+                    state.rate = max(self.MIN_RATE, sent_rate / 2)
+                    state.rate_step = max(self.MIN_RATE, sent_rate) / 100
+                    state.tokens = 0.0
+                    state.updated = now
+                    if retry_after is None:
+                        retry_after = self.cooldown * (2 ** min(state.throttles, 10))
+                    state.throttles += 1
+                    debug(f"{state.host} throttled ({status}); concurrency limit {int(state.limit)}, "
+                          f"{state.rate:.1f} requests/s")
+                if retry_after is not None:
+                    state.blocked_until = max(state.blocked_until, now + min(retry_after, self.max_cooldown))
+            elif status is not None and status < 500:
+                state.throttles = 0
+                state.limit = min(self.max_concurrency, state.limit + 1 / state.limit)
+                if state.rate is not None:
+                    state.rate = min(self.rate or float('inf'), state.rate + state.rate_step)
+            self._condition.notify_all()
+
+    def limits(self):
+        """
+        Returns {host: (concurrency limit, requests per second)} as currently adapted
+        """
+        with self._condition:
+            return {host: (int(state.limit), state.rate) for host, state in self._hosts.items()}
+
+
+class HttpClient:
+    """
+    Shared fetch layer for every page, JSON and image request.
+
+    Uses one requests.Session whose connection pools keep connections to each host
+    alive between requests, and adds timeouts, retries with exponential backoff,
+    Range requests and response size limits on top. Requests are paced per host by a
+    HostScheduler, and responses go through the disk cache when it is enabled.
+
+    The pipeline itself fetches from its own worker threads. For code embedding the
+    client, `aget`/`aget_many` (for asyncio code) and `get_many` (for synchronous
+    code) run requests on a bounded thread pool, so many pages and images can be in
+    flight at once without a separate async HTTP dependency.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    DEFAULT_MAX_BYTES = {'page': 10 * 1024 * 1024, 'image': 25 * 1024 * 1024}
+
+    def __init__(self, max_concurrency=16, connect_timeout=5, read_timeout=10, retries=2,
+                 backoff_factor=0.5, max_bytes=None, host_rate=None, host_burst=20,
+                 max_retry_after=60.0):
+        self.max_concurrency = max_concurrency
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_bytes = dict(self.DEFAULT_MAX_BYTES, **(max_bytes or {}))
+        # A Retry-After longer than this is not waited for; the response is returned as is
+        self.max_retry_after = max_retry_after
+        self.scheduler = HostScheduler(rate=host_rate, burst=host_burst, max_concurrency=max_concurrency,
+                                       max_cooldown=max_retry_after)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return (self.connect_timeout, self.read_timeout)
+        return timeout
+
+    def _backoff(self, attempt):
+        time.sleep(self.backoff_factor * (2 ** attempt) + random.uniform(0, self.backoff_factor))
+
+    def _read_body(self, response, max_bytes, on_chunk=None):
+        response.truncated = False
+        response.chunks_seen = False
+        length = response.headers.get('Content-Length')
+        if on_chunk is None and max_bytes and length and length.isdigit() and int(length) > max_bytes:
+            response.close()
+            raise ResponseTooLarge(f"{response.url} is {length} bytes (limit {max_bytes})")
+
+        chunks = []
+        total = 0
+        for chunk in response.iter_content(64 * 1024):
+            total += len(chunk)
+            if max_bytes and total > max_bytes:
+                if on_chunk is None:
+                    response.close()
+                    raise ResponseTooLarge(f"{response.url} exceeds {max_bytes} bytes")
+                chunk = chunk[:len(chunk) - (total - max_bytes)]
+                response.truncated = True
+            chunks.append(chunk)
+            response.chunks_seen = True
+            if on_chunk is not None and (on_chunk(response, chunk) or response.truncated):
+                response.truncated = True
+                response.close()
+                break
+        response._content = b''.join(chunks)
+
+    def request(self, method, url, kind='page', headers=None, timeout=None, retries=None,
+                max_bytes=None, byte_range=None, on_chunk=None):
+        """
+        Sends a request with retries, returning the response with its body read
+        
+        Args:
+            method: HTTP method ('GET' or 'HEAD')
+            url: URL to fetch
+            kind: Content type ('page' or 'image'), selects the default size limit
+            headers: Request headers
+            timeout: Timeout in seconds, or a (connect, read) tuple
+            retries: Number of retries on connection errors and 429/5xx responses; 429
+                and 503 responses are retried after the host's Retry-After pause
+            max_bytes: Maximum body size; larger responses raise ResponseTooLarge
+            byte_range: Optional (start, end) tuple sent as a Range header (end inclusive)
+            on_chunk: Optional callable(response, chunk) called with each decoded body chunk
+                as it arrives; returning True stops the download. With on_chunk, a body
+                over max_bytes is cut off at the limit instead of raising ResponseTooLarge.
+                Either way the response is marked `truncated`. If the connection fails
+                after on_chunk has been given data, the request is only retried when
+                on_chunk has a reset() method, which is called before the body is sent
+                again from the start.
+        """
+        headers = dict(headers or {})
+        if byte_range is not None:
+            headers['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        retries = self.retries if retries is None else retries
+        max_bytes = self.max_bytes.get(kind) if max_bytes is None else max_bytes
+
+        for attempt in range(retries + 1):
+            host = self.scheduler.acquire(url, kind)
+            status = retry_after = response = None
+            try:
+                response = self.session.request(method, url, headers=headers,
+                                                timeout=self._timeout(timeout), stream=True)
+                status = response.status_code
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if (status in self.RETRY_STATUSES and attempt < retries
+                        and (retry_after or 0) <= self.max_retry_after):
+                    response.close()
+                    metrics.incr('http_retries', kind=kind, reason=str(status))
+                else:
+                    if method == 'HEAD':
+                        response.close()
+                    else:
+                        self._read_body(response, max_bytes, on_chunk)
+                    return response
+            except ResponseTooLarge:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                debug(f"Attempt {attempt + 1} failed for {url}: {str(e)}")
+                if attempt == retries:
+                    raise
+                if on_chunk is not None and getattr(response, 'chunks_seen', False):
+                    if not hasattr(on_chunk, 'reset'):
+                        raise
+                    on_chunk.reset()
+                metrics.incr('http_retries', kind=kind, reason=e.__class__.__name__)
+            finally:
+                self.scheduler.release(host, status, retry_after)
+            # After a 429/503 the scheduler pauses the whole host instead
+            if status not in HostScheduler.THROTTLE_STATUSES:
+                self._backoff(attempt)
+
+    def get(self, url, kind='page', headers=None, timeout=None, retries=None, max_bytes=None,
+            byte_range=None, use_cache=True, on_chunk=None):
+        """
+        GETs a URL through the disk cache when it is enabled
+        
+        Returns a requests.Response whose body is already content-decoded. Responses
+        served from the cache have `from_cache` set to True. Raises for HTTP errors.
+        Truncated responses (see request()) are cached as partial bodies; these are
+        served (marked `truncated`) only to callers passing on_chunk, who could have
+        stopped the download themselves, and are not fed through on_chunk again.
+        """
+        with metrics.span(f'fetch.{kind}'):
+            cache = disk_cache if use_cache and byte_range is None else None
+            entry = cache.lookup(url) if cache else None
+            if entry and entry.get('partial') and on_chunk is None:
+                entry = None
+            headers = dict(headers or {})
+
+            if entry and cache.is_fresh(entry):
+                data = cache.read(entry)
+                if data is not None:
+                    metrics.incr('cache_hits', kind=kind, result='fresh')
+                    return _cached_response(url, data, entry)
+                entry = None
+
+            request_headers = dict(headers, **(cache.conditional_headers(entry) if entry else {}))
+            response = self.request('GET', url, kind, request_headers, timeout, retries, max_bytes, byte_range, on_chunk)
+            metrics.incr('http_requests', kind=kind)
+            if entry and response.status_code == 304:
+                data = cache.read(entry)
+                if data is not None:
+                    metrics.incr('cache_hits', kind=kind, result='revalidated')
+                    cache.revalidated(entry)
+                    return _cached_response(url, data, entry)
+                # Evicted while the request was in flight; fetch the body unconditionally
+                response = self.request('GET', url, kind, headers, timeout, retries, max_bytes, byte_range, on_chunk)
+                metrics.incr('http_requests', kind=kind)
+
+            response.raise_for_status()
+            metrics.incr('bytes_fetched', len(response.content), kind=kind)
+            response.from_cache = False
+            if response.truncated:
+                metrics.incr('responses_truncated', kind=kind)
+            if cache:
+                cache.store(url, kind, response.content, response.headers, encoding=response.encoding,
+                            partial=response.truncated)
+                # The stored body is already decoded, so drop the transfer encoding headers
+                response.headers.pop('Content-Encoding', None)
+            return response
+
+    def head(self, url, headers=None, timeout=None, retries=None):
+        return self.request('HEAD', url, headers=headers, timeout=timeout, retries=retries)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='http')
+            return self._executor
+
+    async def aget(self, url, **kwargs):
+        """
+        Coroutine version of get(), run on the client's bounded fetch pool
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(self.get, url, **kwargs))
+
+    async def aget_many(self, urls, **kwargs):
+        """
+        Fetches many URLs concurrently, returning responses (or exceptions) in input order
+        """
+        return await asyncio.gather(*(self.aget(url, **kwargs) for url in urls), return_exceptions=True)
+
+    def get_many(self, urls, **kwargs):
+        """
+        Blocking version of aget_many() for synchronous callers
+        
+        Runs on the same fetch pool without an event loop, so it can also be called from
+        code that is itself running inside one (where asyncio.run() would fail).
+        """
+        futures = [self._get_executor().submit(self.get, url, **kwargs) for url in urls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.session.close()
+
+http_client = HttpClient()
+
+def configure_http(**kwargs):
+    """
+    Replaces the shared HTTP client, e.g. configure_http(max_concurrency=32, read_timeout=20)
+    """
+    global http_client
+    old_client = http_client
+    http_client = HttpClient(**kwargs)
+    old_client.close()
+    return http_client
+
+def fetch_url(url, kind='page', headers=None, timeout=None, **kwargs):
+    """
+    GETs a URL through the shared HTTP client (see HttpClient.get)
+    """
+    return http_client.get(url, kind=kind, headers=headers, timeout=timeout, **kwargs)
+
+class ImageStore:
+    """
+    Per-run, in-memory store of downloaded images keyed by their URL.
+
+    Keys only normalise what cannot change the resource (scheme and host case, a
+    missing scheme, the fragment), and the key is what is downloaded, so validation,
+    hashing and assets are computed from the same file the creative links to. Holds
+    the raw bytes of every image together with values derived from them (decoded
+    arrays, validation results), so each image is fetched and decoded at most once
+    per run. Least recently used entries are evicted once the memory cap is exceeded.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._headers = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url):
+        if url.startswith('data:'):
+            return url
+        if url.startswith('//'):
+            url = 'https:' + url
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _add_size(self, entry, nbytes):
+        with self._lock:
+            entry['size'] += nbytes
+            if self._entries.get(entry['key']) is entry:
+                self._size += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._size -= old['size']
+
+    def get_bytes(self, url):
+        """
+        Returns the raw bytes of an image, downloading it on first use
+        """
+        key = self.key(url)
+        entry = self._lookup(key)
+        metrics.incr('image_store_lookups', result='hit' if entry is not None else 'miss')
+        if entry is None:
+            entry = {'key': key, 'data': None, 'error': None, 'derived': {}, 'size': 0}
+            try:
+                entry['data'] = _fetch_image_bytes(key)
+                entry['size'] = len(entry['data'])
+            except Exception as e:
+                entry['error'] = e
+            with self._lock:
+                existing = self._entries.get(key)
+                if existing is not None:
+                    entry = existing
+                else:
+                    self._entries[key] = entry
+                    self._size += entry['size']
+                    self._evict()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['data']
+
+    def get_derived(self, url, name, compute):
+        """
+        Returns a value derived from an image's bytes, computing it on first use
+
+        Args:
+            url: URL of the image
+            name: Hashable name of the derived value (e.g. 'dhash')
+            compute: Callable taking the raw image bytes and returning the value
+        """
+        data = self.get_bytes(url)
+        entry = self._lookup(self.key(url))
+        if entry is not None and name in entry['derived']:
+            return entry['derived'][name]
+        value = compute(data)
+        if entry is not None:
+            entry['derived'][name] = value
+            self._add_size(entry, getattr(value, 'nbytes', 0))
+        return value
+
+    def get_header(self, url):
+        """
+        Returns the ImageHeader of an image, or None if it is unknown; only the start of
+        the file is fetched (see probe_image_header) unless the image is already stored
+        """
+        key = self.key(url)
+        entry = self._lookup(key)
+        if entry is not None:
+            return parse_image_header(entry['data']) if entry['data'] else None
+        with self._lock:
+            if key in self._headers:
+                return self._headers[key]
+        header = probe_image_header(key)
+        with self._lock:
+            self._headers[key] = header
+        return header
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._headers.clear()
+            self._size = 0
+
+image_store = ImageStore()
+
+def _fetch_image_bytes(url):
+    if url.startswith('data:'):
+        return urlopen(url).read()
+    return fetch_url(url, 'image', timeout=5).content
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python 3.7: image bytes are pickled to the workers instead
+    shared_memory = None
+
+def _run_on_shared_bytes(function, block_name, size, args):
+    # Runs in a CPU pool worker: attaches to the parent's shared memory block and calls
+    # function(buffer, *args) on it without copying the image through the task pipe
+    # Spawned workers share the parent's resource tracker, so attaching here does not
+    # make this process an owner; the parent unlinks the block once the call returns
+    block = shared_memory.SharedMemory(name=block_name)
+    data = block.buf[:size]
+    try:
+        return function(data, *args)
+    finally:
+        data.release()
+        block.close()
+
+class CpuPool:
+    """
+    A pool of worker processes for CPU-bound image work (decoding, scoring, hashing,
+    resizing, CV detection), so it runs on every core instead of contending for the GIL.
+
+    Callers on the fetch/validation threads block on run(), which copies the image
+    bytes into a shared memory block that the worker maps directly, rather than
+    pickling them through the task queue. Functions must be module-level and take the
+    image bytes (a bytes-like buffer) as their first argument.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        # Workers are spawned rather than forked: the parent has live threads and sessions
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def run(self, function, data, *args):
+        if shared_memory is None or not data:
+            return self.executor.submit(function, bytes(data), *args).result()
+        block = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            block.buf[:len(data)] = data
+            return self.executor.submit(_run_on_shared_bytes, function, block.name, len(data), args).result()
+        finally:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+cpu_pool = None
+
+def enable_cpu_pool(workers=None):
+    """
+    Runs CPU-bound image work on a pool of worker processes (default: one per core)
+    """
+    global cpu_pool
+    if cpu_pool is not None:
+        cpu_pool.close()
+    cpu_pool = CpuPool(workers)
+    atexit.register(cpu_pool.close)
+    return cpu_pool
+
+def cpu_call(function, data, *args):
+    """
+    Returns function(data, *args), computed on the CPU pool when it is enabled
+    """
+    if cpu_pool is None:
+        return function(data, *args)
+    return cpu_pool.run(function, data, *args)
+
+def offload(function, *args):
+    """
+    Returns a compute(data) callable for ImageStore.get_derived that runs on the CPU pool
+    """
+    return lambda data: cpu_call(function, data, *args)
+
+IMAGE_PROBE_BYTES = 16 * 1024
+
+ImageHeader = namedtuple('ImageHeader', ['format', 'width', 'height'])
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def parse_image_header(data):
+    """
+    Returns the ImageHeader (format and pixel size) of a JPEG, PNG, GIF or WebP image
+    from the first bytes of the file, or None if they do not contain it
+    """
+    try:
+        if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', data[16:24])
+            return ImageHeader('PNG', width, height)
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', data[6:10])
+            return ImageHeader('GIF', width, height)
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            chunk = data[12:16]
+            if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+                width, height = struct.unpack('<HH', data[26:30])
+                return ImageHeader('WEBP', width & 0x3FFF, height & 0x3FFF)
+            if chunk == b'VP8L' and data[20:21] == b'\x2f':
+                bits = struct.unpack('<I', data[21:25])[0]
+                return ImageHeader('WEBP', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+            if chunk == b'VP8X':
+                width = int.from_bytes(data[24:27], 'little') + 1
+                height = int.from_bytes(data[27:30], 'little') + 1
+                return ImageHeader('WEBP', width, height)
+            return None
+        if data[:2] == b'\xff\xd8':
+            # Walk the marker segments up to the start-of-frame, which holds the size
+            i = 2
+            while i + 9 <= len(data):
+                if data[i] != 0xFF:
+                    return None
+                marker = data[i + 1]
+                if marker == 0xFF:
+                    i += 1
+                    continue
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    i += 2
+                    continue
+                if marker in _JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                    return ImageHeader('JPEG', width, height)
+                i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    except struct.error:
+        pass
+    return None
+
+def probe_image_header(url, probe_bytes=IMAGE_PROBE_BYTES):
+    """
+    Reads the ImageHeader of a remote image by fetching only its first bytes
+    
+    Sends a Range request for the first probe_bytes and stops reading as soon as the
+    header has been parsed, so servers that ignore Range cost one chunk too. Returns
+    None when the size could not be determined (unknown format, a JPEG whose metadata
+    is larger than probe_bytes, request errors) or the image is already in the disk
+    cache, where reading it whole is cheaper than another request.
+    """
+    if url.startswith('data:') or (disk_cache is not None and disk_cache.lookup(url)):
+        return None
+
+    received = []
+    found = []
+
+    def on_chunk(response, chunk):
+        received.append(chunk)
+        header = parse_image_header(b''.join(received))
+        if header:
+            found.append(header)
+        return bool(header)
+
+    with metrics.span('image.probe'):
+        try:
+            fetch_url(url, 'image', timeout=5, retries=1, byte_range=(0, probe_bytes - 1),
+                      max_bytes=probe_bytes, on_chunk=on_chunk)
+        except requests.exceptions.RequestException as e:
+            debug(f"Image probe failed for {url}: {str(e)}")
+            return None
+    metrics.incr('image_probes', result='parsed' if found else 'unknown')
+    return found[0] if found else None
+
+QUALITY_PROXY_SIZE = 512
+# Images up to this many pixels are scored at full resolution, larger ones on a proxy
+QUALITY_FULL_MAX_PIXELS = 1024 * 1024
+
+class ImageQuality(namedtuple('ImageQuality', ['width', 'height', 'std_dev', 'entropy', 'pixelation', 'reason'])):
+    """
+    Result of scoring an image. `reason` is None for accepted images, otherwise one of
+    'fetch_error', 'decode_error', 'too_small', 'blank', 'low_quality' or 'pixelated'.
+    The object is truthy only when the image was accepted.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.reason is None
+
+    def __bool__(self):
+        return self.reason is None
+
+PIXELATION_TILE = 64
+PIXELATION_TILE_MARGIN = 16
+
+def _pixelation_spans(size, limit):
+    # Evenly spread, 4-aligned (start, end) ranges covering at most `limit` pixels of an axis
+    if size <= limit:
+        return [(0, size)]
+    count = limit // PIXELATION_TILE
+    step = (size - PIXELATION_TILE) / (count - 1)
+    return [(int(i * step) // 4 * 4, int(i * step) // 4 * 4 + PIXELATION_TILE) for i in range(count)]
+
+def _pixelation(img, limit=QUALITY_PROXY_SIZE):
+    """
+    Returns the pixelation metric of an RGB image (see score_image)
+    
+    An image of up to twice limit x limit pixels is measured whole; below that the
+    tiles, with their margins, would not touch fewer pixels. Otherwise the metric is
+    the mean over a grid of full-resolution tiles, covering at most limit pixels along
+    each side, spread over the image; each tile is reduced together with a margin
+    around it, so the resampling filter sees the same neighbourhood as in the whole
+    image, and only the tile itself is compared.
+    """
+    width, height = img.size
+    if width * height <= 2 * limit * limit:
+        restored = img.resize((width // 4, height // 4), Image.Resampling.LANCZOS).resize(img.size, Image.Resampling.NEAREST)
+        return float((np.asarray(img) - np.asarray(restored)).mean())
+
+    total = count = 0
+    margin = PIXELATION_TILE_MARGIN
+    for top, bottom in _pixelation_spans(height, limit):
+        for left, right in _pixelation_spans(width, limit):
+            outer_left, outer_top = max(0, left - margin), max(0, top - margin)
+            outer_width = (min(width, right + margin) - outer_left) // 4 * 4
+            outer_height = (min(height, bottom + margin) - outer_top) // 4 * 4
+            tile = img.crop((outer_left, outer_top, outer_left + outer_width, outer_top + outer_height))
+            restored = tile.resize((outer_width // 4, outer_height // 4), Image.Resampling.LANCZOS).resize(
+                tile.size, Image.Resampling.NEAREST)
+            inner = (slice(top - outer_top, bottom - outer_top), slice(left - outer_left, right - outer_left))
+            diff = np.asarray(tile)[inner] - np.asarray(restored)[inner]
+            total += int(diff.sum(dtype=np.uint64))
+            count += diff.size
+    return total / count
+
+def score_image(image_data, min_width=200, min_height=200, max_compression_ratio=0.1,
+                proxy_size=QUALITY_PROXY_SIZE):
+    """
+    Scores an image's quality from its raw bytes
+    
+    The size check uses the real dimensions from the header. The other checks match
+    the original full-resolution ones (benchmarks/bench_image_quality.py compares
+    their decisions) while touching fewer pixels:
+    - std_dev: standard deviation of all channel values (blank/solid color check)
+    - entropy: Shannon entropy of the concatenated per-channel histograms
+      Both come from the 768-bin histogram, of the whole image or, above
+      QUALITY_FULL_MAX_PIXELS, of a proxy thumbnailed to proxy_size.
+    - pixelation: the mean difference between the image and a copy reduced 4x and
+      scaled back up, taken in uint8 like the original check (negative differences
+      wrap around) so its threshold carries over; larger images are sampled with a
+      grid of full-resolution tiles (see _pixelation)
+    """
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        width, height = img.size
+        if width < min_width or height < min_height:
+            return ImageQuality(width, height, 0.0, 0.0, 0.0, 'too_small')
+
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.load()
+        proxy = img
+        if width * height > QUALITY_FULL_MAX_PIXELS and max(img.size) > proxy_size:
+            proxy = img.copy()
+            proxy.thumbnail((proxy_size, proxy_size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        counts = np.asarray(proxy.histogram(), dtype=np.float64)
+    except Exception:
+        return ImageQuality(0, 0, 0.0, 0.0, 0.0, 'decode_error')
+
+    values = np.tile(np.arange(256, dtype=np.float64), 3)
+    total = counts.sum()
+    mean = (counts * values).sum() / total
+    std_dev = float(np.sqrt(max(0.0, (counts * values * values).sum() / total - mean * mean)))
+    if std_dev < 10:  # Arbitrary threshold for "blankness"
+        return ImageQuality(width, height, std_dev, 0.0, 0.0, 'blank')
+
+    probabilities = counts[counts > 0] / total
+    entropy = float(-(probabilities * np.log2(probabilities)).sum())
+    if entropy < max_compression_ratio * np.log2(256):
+        return ImageQuality(width, height, std_dev, entropy, 0.0, 'low_quality')
+
+    pixelation = _pixelation(img, proxy_size)
+    if pixelation < 5:  # Arbitrary threshold for pixelation
+        return ImageQuality(width, height, std_dev, entropy, pixelation, 'pixelated')
+
+    return ImageQuality(width, height, std_dev, entropy, pixelation, None)
+
+def is_valid_image(image_url, min_width=200, min_height=200, max_compression_ratio=0.1, store=None):
+    """
+    Checks if an image is valid based on:
+    1. Not being blank/solid color
+    2. Meeting minimum resolution requirements
+    3. Not being too pixelated/low quality
+    
+    Args:
+        image_url: URL of the image to check
+        min_width: Minimum acceptable width in pixels
+        min_height: Minimum acceptable height in pixels
+        max_compression_ratio: Maximum acceptable compression ratio (lower means more compressed/lower quality)
+        store: ImageStore to fetch through (defaults to the per-run image_store)
+    
+    Returns the ImageQuality score, which is truthy only for valid images. Images
+    whose header already shows they are too small are rejected without downloading
+    the rest of the file.
+    """
+    store = store or image_store
+
+    header = store.get_header(image_url)
+    if header and (header.width < min_width or header.height < min_height):
+        metrics.incr('images_rejected', reason='too_small')
+        debug(f"Image rejected (too_small, from header): {header.width}x{header.height} {image_url}")
+        return ImageQuality(header.width, header.height, 0.0, 0.0, 0.0, 'too_small')
+
+    def compute(data):
+        with metrics.span('image.validate'):
+            return cpu_call(score_image, data, min_width, min_height, max_compression_ratio)
+
+    try:
+        quality = store.get_derived(image_url, ('quality', min_width, min_height, max_compression_ratio), compute)
+    except Exception as e:
+        debug(f"Error checking image {image_url}: {str(e)}")
+        metrics.incr('images_rejected', reason='fetch_error')
+        return ImageQuality(0, 0, 0.0, 0.0, 0.0, 'fetch_error')
+
+    if not quality.ok:
+        metrics.incr('images_rejected', reason=quality.reason)
+        debug(f"Image rejected ({quality.reason}): {quality.width}x{quality.height} "
+              f"std_dev={quality.std_dev:.1f} entropy={quality.entropy:.2f} pixelation={quality.pixelation:.2f}")
+    return quality
+
+def dhash(image_data, hash_size=8):
+    """
+    Computes a 64-bit difference hash (dHash) of an image
+    
+    The image is reduced to a (hash_size + 1) x hash_size grayscale grid and each bit
+    records whether a pixel is brighter than its right-hand neighbour, so re-encoded,
+    resized or slightly recompressed copies of an image hash to nearby values.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    img.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+def max_hash_distance(similarity_threshold, hash_bits=64):
+    """
+    Converts a 0-1 similarity threshold into the number of hash bits allowed to differ
+    """
+    return int((1 - similarity_threshold) * hash_bits)
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit perceptual hashes, for finding every stored hash
+    within a Hamming distance of a query without comparing against all of them.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, hash_value, item):
+        node = [hash_value, item, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, max_distance):
+        """
+        Returns (distance, item) pairs for every stored hash within max_distance, closest first
+        """
+        results = []
+        candidates = [self._root] if self._root is not None else []
+        while candidates:
+            node_hash, item, children = candidates.pop()
+            distance = hamming_distance(hash_value, node_hash)
+            if distance <= max_distance:
+                results.append((distance, item))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+class ImageHashIndex:
+    """
+    Thread-safe index of accepted images by perceptual hash. Used for duplicate
+    detection across every product of a catalog run.
+    """
+
+    def __init__(self, similarity_threshold=0.95, store=None):
+        self.max_distance = max_hash_distance(similarity_threshold)
+        self.store = store
+        self._tree = BKTree()
+        self._items = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tree)
+
+    def add(self, image_url, owner=None):
+        hash_value = (self.store or image_store).get_derived(image_url, 'dhash', offload(dhash))
+        with self._lock:
+            if (image_url, owner) not in self._items:
+                self._items.add((image_url, owner))
+                self._tree.add(hash_value, (image_url, owner))
+
+    def find_duplicate(self, image_url, owner=None):
+        """
+        Returns the closest indexed (image_url, owner) within the threshold, ignoring
+        images indexed for the same owner, or None
+        """
+        hash_value = (self.store or image_store).get_derived(image_url, 'dhash', offload(dhash))
+        with self._lock:
+            matches = self._tree.search(hash_value, self.max_distance)
+        for _, match in matches:
+            if owner is None or match[1] != owner:
+                return match
+        return None
+
+catalog_image_index = None
+
+def enable_catalog_dedup(similarity_threshold=0.95):
+    """
+    Rejects images that duplicate one already accepted for another product in this run
+    """
+    global catalog_image_index
+    catalog_image_index = ImageHashIndex(similarity_threshold)
+    return catalog_image_index
+
+def is_duplicate_image(new_image_url, existing_images, similarity_threshold=0.95, store=None):
+    """
+    Checks if an image is a duplicate of existing images by comparing perceptual hashes
+    
+    Args:
+        new_image_url: URL of the image to check
+        existing_images: List of existing image URLs
+        similarity_threshold: Threshold for considering images as duplicates (0-1)
+        store: ImageStore to fetch through (defaults to the per-run image_store)
+    """
+    store = store or image_store
+    max_distance = max_hash_distance(similarity_threshold)
+    with metrics.span('image.dedup'):
+        try:
+            new_hash = store.get_derived(new_image_url, 'dhash', offload(dhash))
+            
+            for existing_url in existing_images:
+                try:
+                    existing_hash = store.get_derived(existing_url, 'dhash', offload(dhash))
+                    
+                    distance = hamming_distance(new_hash, existing_hash)
+                    if distance <= max_distance:
+                        metrics.incr('images_rejected', reason='duplicate')
+                        debug(f"Image rejected (duplicate): hash distance={distance}")
+                        return True
+                        
+                except Exception as e:
+                    debug(f"Error comparing with existing image {existing_url}: {str(e)}")
+                    continue
+                    
+            return False
+            
+        except Exception as e:
+            debug(f"Error checking duplicate {new_image_url}: {str(e)}")
+            return False
+
+GENERIC_IMAGE_SELECTORS = [
+    '[id*="product"][id*="image"] img', '[class*="product"][class*="image"] img',
+    '[id*="product"][id*="photo"] img', '[class*="product"][class*="photo"] img',
+    '[id*="product"][id*="media"] img', '[class*="product"][class*="media"] img',
+    '[id*="product"] img', '[class*="product"] img',
+    
+    '[class*="gallery"] img', '[class*="slider"] img', '[class*="carousel"] img',
+    '[class*="slide"] img', '[class*="thumbnail"] img', '[class*="preview"] img',
+    '.swiper img', '.slick img', '.owl-carousel img',
+    
+    '[class*="main-image"]', '[class*="featured-image"]', '[class*="product-image"]',
+    '[class*="hero-image"]', '[class*="zoom"]', '[class*="magnify"]',
+    
+    '[class*="image-container"] img', '[class*="img-container"] img',
+    '[class*="photo-container"] img', '[class*="media-container"] img',
+    
+    '[data-image]', '[data-src]', '[data-lazy]', '[data-srcset]',
+    '[data-zoom]', '[data-zoom-image]', '[data-large]', '[data-full]',
+    '[data-slide]', '[data-thumb]', '[data-preview]',
+    
+    '[itemprop="image"]', '[property="og:image"]',
+    
+    'main img', 'article img', '.content img', '.product img',
+    '.details img', '.info img', '.description img'
+]
+
+IMAGE_ATTRIBUTES = [
+    'src', 'data-src', 'data-original', 'data-lazy', 'data-srcset',
+    'data-zoom-image', 'data-large', 'data-full', 'data-image',
+    'data-zoom', 'data-high-res', 'data-retina', 'srcset',
+    'data-original-src', 'data-lazy-src', 'data-master',
+    'data-thumb', 'data-slide-img', 'data-normal',
+    'data-zoom-src', 'data-large-src', 'data-big',
+    'data-super-size', 'data-xlarge', 'href'
+]
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+SHOPIFY_GALLERY_SELECTORS = [
+    '.product-gallery__image img',
+    '.product__media-item img',
+    '.product-single__media img',
+    '.product-single__photo img',
+    '[data-product-media-type="image"] img',
+    '.product__slide img',
+    '.product-single__thumbnail img'
+]
+
+_SELECTOR_TOKEN = re.compile(r'([a-zA-Z][\w-]*)|\.([\w-]+)|\[([\w:-]+)(?:(\*?=)"([^"]*)")?\]')
+
+def compile_selector(selector):
+    """
+    Compiles a simple CSS selector into one (tag, classes, attribute tests) step per
+    descendant level. Supports tag names, .class, [attr], [attr="value"] and
+    [attr*="value"] joined by descendant combinators, which covers every selector
+    in the image selector tables.
+    """
+    steps = []
+    for compound in selector.split():
+        tag = None
+        classes = []
+        attr_tests = []
+        position = 0
+        for match in _SELECTOR_TOKEN.finditer(compound):
+            if match.start() != position:
+                break
+            position = match.end()
+            name, class_name, attr, operator, value = match.groups()
+            if name:
+                tag = name.lower()
+            elif class_name:
+                classes.append(class_name)
+            else:
+                attr_tests.append((attr, operator, value))
+        if position != len(compound):
+            raise ValueError(f"Unsupported selector: {selector}")
+        steps.append((tag, tuple(classes), tuple(attr_tests)))
+    return steps
+
+class PageNode:
+    """
+    An element of a PageIndex with the attributes selector matching needs
+    precomputed, linked to its parent node.
+    """
+    __slots__ = ('element', 'name', 'attrs', 'classes', 'parent')
+
+    def __init__(self, element, parent):
+        self.element = element
+        self.name = element.name
+        self.attrs = element.attrs
+        classes = element.attrs.get('class') or ()
+        self.classes = classes.split() if isinstance(classes, str) else classes
+        self.parent = parent
+
+    def attr_string(self, attr):
+        value = self.attrs.get(attr)
+        if value is None:
+            return None
+        return value if isinstance(value, str) else ' '.join(value)
+
+    def matches(self, step):
+        tag, classes, attr_tests = step
+        if tag is not None and self.name != tag:
+            return False
+        for class_name in classes:
+            if class_name not in self.classes:
+                return False
+        for attr, operator, value in attr_tests:
+            actual = self.attr_string(attr)
+            if actual is None:
+                return False
+            if operator == '=' and actual != value:
+                return False
+            if operator == '*=' and value not in actual:
+                return False
+        return True
+
+    def matches_selector(self, steps):
+        if not self.matches(steps[-1]):
+            return False
+        ancestor = self.parent
+        for step in reversed(steps[:-1]):
+            while ancestor is not None and not ancestor.matches(step):
+                ancestor = ancestor.parent
+            if ancestor is None:
+                return False
+            ancestor = ancestor.parent
+        return True
+
+class PageIndex:
+    """
+    Everything the extraction strategies read from a product page, collected in a
+    single walk over the parsed document:
+    - scripts: non-empty bodies of every <script>, in document order
+    - ld_json: parsed JSON-LD objects
+    - meta: content of <meta> tags by their property (first occurrence wins)
+    - image_nodes: elements that are <img> tags or carry an image attribute, with
+      their ancestors linked so the selector tables can be matched without
+      re-scanning the tree
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+        self.scripts = []
+        self.ld_json = []
+        self.meta = {}
+        self.image_nodes = []
+        self._selectors = {}
+
+        image_attributes = set(IMAGE_ATTRIBUTES)
+        nodes = {}
+        for element in soup.descendants:
+            if not isinstance(element, Tag):
+                continue
+            node = PageNode(element, nodes.get(id(element.parent)))
+            nodes[id(element)] = node
+            name = element.name
+
+            if name == 'script':
+                body = element.string
+                if body:
+                    self.scripts.append(body)
+                    if element.get('type') == 'application/ld+json':
+                        try:
+                            self.ld_json.append(json.loads(body))
+                        except ValueError:
+                            pass
+            elif name == 'meta':
+                key = element.get('property')
+                if key and key not in self.meta:
+                    self.meta[key] = element.get('content')
+
+            if name == 'img' or not image_attributes.isdisjoint(element.attrs):
+                self.image_nodes.append(node)
+
+    @classmethod
+    def from_html(cls, content, parser=None):
+        return cls(BeautifulSoup(content, parser or HTML_PARSER))
+
+    def select_images(self, selector):
+        """
+        Yields the image-bearing elements matching a selector, in document order
+        """
+        steps = self._selectors.get(selector)
+        if steps is None:
+            steps = self._selectors[selector] = compile_selector(selector)
+        for node in self.image_nodes:
+            if node.matches_selector(steps):
+                yield node.element
+
+def iter_generic_image_candidates(page, product_url, existing_images=()):
+    """
+    Yields candidate image URLs found by the generic selectors, in selector priority order
+    
+    Selectors are only evaluated as the consumer asks for more candidates, and URLs
+    already in existing_images or yielded before are skipped.
+    """
+    parsed_url = urlparse(product_url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    seen = {img.split('?')[0] for img in existing_images}
+
+    for selector in GENERIC_IMAGE_SELECTORS:
+        for img in page.select_images(selector):
+            for attr in IMAGE_ATTRIBUTES:
+                src = img.get(attr)
+                if not src or not isinstance(src, str):
+                    continue
+                if attr == 'srcset':
+                    src = src.split(',')[0].strip().split(' ')[0]
+                    if not src:
+                        continue
+
+                if src.startswith('//'):
+                    src = 'https:' + src
+                elif src.startswith('/'):
+                    src = base_url + src
+                elif not src.startswith(('http://', 'https://')):
+                    src = f"{base_url}/{src.lstrip('/')}"
+
+                base_src = src.split('?')[0]
+                if base_src in seen or not base_src.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                seen.add(base_src)
+                yield src
+
+IMAGE_VALIDATION_WORKERS = 8
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+def get_image_executor():
+    """
+    Returns the thread pool shared by all image validation work in this process
+    """
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is None:
+            _image_executor = ThreadPoolExecutor(max_workers=IMAGE_VALIDATION_WORKERS,
+                                                 thread_name_prefix='image')
+        return _image_executor
+
+def _prepare_image(image_url):
+    # Runs on a worker thread: fetch, decode and score the image, and precompute the
+    # perceptual hash the duplicate check needs so the in-order pass only does lookups.
+    if not is_valid_image(image_url):
+        return False
+    try:
+        image_store.get_derived(image_url, 'dhash', offload(dhash))
+    except Exception:
+        pass
+    return True
+
+def select_valid_images(candidates, accepted=None, limit=4, dedupe=True, owner=None):
+    """
+    Validates candidate image URLs concurrently and returns the accepted ones
+    
+    Candidates are fetched, decoded and scored on the shared image pool, a bounded
+    window ahead of the current position, but accepted strictly in candidate order,
+    so the result is the same as checking them one by one. Stops (and cancels the
+    remaining work) as soon as `limit` images are accepted.
+    
+    Args:
+        candidates: Iterable of image URLs in priority order; may be a lazy generator
+        accepted: Images already accepted; they count towards the limit and are
+            compared against for duplicates
+        limit: Maximum number of accepted images, or None for no limit
+        dedupe: Whether to reject candidates that duplicate an accepted image
+        owner: Product the images are for; when catalog dedup is enabled, candidates that
+            duplicate an image accepted for another product are rejected (even without
+            dedupe), and accepted ones are added to the catalog index
+    """
+    accepted = list(accepted or [])
+    executor = get_image_executor()
+    window = IMAGE_VALIDATION_WORKERS * 2
+    candidates = iter(candidates)
+    pending = deque()
+
+    try:
+        while limit is None or len(accepted) < limit:
+            while len(pending) < window:
+                url = next(candidates, None)
+                if url is None:
+                    break
+                if url.startswith('data:image'):
+                    pending.append((url, None))
+                else:
+                    pending.append((url, executor.submit(_prepare_image, url)))
+            if not pending:
+                break
+
+            url, future = pending.popleft()
+            if future is not None and not future.result():
+                continue
+            if future is not None:
+                if dedupe and is_duplicate_image(url, accepted):
+                    continue
+                if catalog_image_index is not None and owner is not None:
+                    match = catalog_image_index.find_duplicate(url, owner)
+                    if match:
+                        metrics.incr('images_rejected', reason='catalog_duplicate')
+                        debug(f"Image rejected (duplicate of {match[0]} from {match[1]})")
+                        continue
+                    catalog_image_index.add(url, owner)
+            accepted.append(url)
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+
+    return accepted
+
+def drop_catalog_duplicates(image_urls, owner, limit=4):
+    """
+    Returns up to `limit` (None for no limit) of image_urls, leaving out images that
+    duplicate one already accepted for another product when catalog dedup is enabled
+    
+    For image lists that are trusted as is (such as Shopify's product JSON): only the
+    perceptual hashes are computed, a bounded window ahead on the shared image pool,
+    and the images are not scored. An image that cannot be fetched is kept, as it
+    would be without catalog dedup.
+    """
+    if catalog_image_index is None:
+        return list(image_urls)[:limit]
+    executor = get_image_executor()
+    image_urls = iter(image_urls)
+    pending = deque()
+    accepted = []
+    try:
+        while limit is None or len(accepted) < limit:
+            while len(pending) < IMAGE_VALIDATION_WORKERS * 2:
+                url = next(image_urls, None)
+                if url is None:
+                    break
+                pending.append((url, executor.submit(image_store.get_derived, url, 'dhash', offload(dhash))))
+            if not pending:
+                break
+
+            url, future = pending.popleft()
+            try:
+                future.result()
+            except Exception as e:
+                debug(f"Could not hash image {url}: {str(e)}")
+                accepted.append(url)
+                continue
+            match = catalog_image_index.find_duplicate(url, owner)
+            if match:
+                metrics.incr('images_rejected', reason='catalog_duplicate')
+                debug(f"Image rejected (duplicate of {match[0]} from {match[1]})")
+                continue
+            catalog_image_index.add(url, owner)
+            accepted.append(url)
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+    return accepted
+
+def add_ad_fields(product_data, product_url):
+    """
+    Adds the store name, pricing and copy fields the ad template expects
+    """
+    parsed_url = urlparse(product_url)
+    store_name = parsed_url.netloc.split('.')[0].upper()
+    if store_name == 'WWW':  
+        store_name = parsed_url.netloc.split('.')[1].upper()
+
+    product_data.update({
+        'brand_name': store_name,
+        'original_price': float(product_data['price']) * 1.2 if product_data.get('price') else None,
+        'discount_percent': 20,
+        'features': [
+            'Premium Quality',
+            'Limited Edition',
+            'Exclusive Design'
+        ],
+        'shipping': 'Free Shipping Available',
+        'product_url': product_url
+    })
+    return product_data
+
+def fetch_shopify_product_json(product_url):
+    """
+    Fetches /products/<handle>.js for a Shopify product URL, returning None if the
+    store doesn't serve it (not Shopify, password protected, removed product, ...)
+    """
+    parsed_url = urlparse(product_url)
+    path_parts = parsed_url.path.rstrip('/').split('/')
+    if 'products' not in path_parts or path_parts[-1] == 'products':
+        return None
+
+    handle = path_parts[-1]
+    json_url = f"{parsed_url.scheme}://{parsed_url.netloc}/products/{handle}.js"
+    try:
+        response = fetch_url(json_url, 'page', headers={'Accept': 'application/json'}, timeout=10)
+        product = response.json()
+    except Exception as e:
+        debug(f"Shopify product JSON unavailable for {product_url}: {str(e)}")
+        return None
+
+    if not isinstance(product, dict) or not product.get('title'):
+        return None
+    return product
+
+def product_data_from_shopify_json(product, product_url):
+    """
+    Builds product_data straight from a Shopify product JSON object, either an entry
+    of /products.json or the response of /products/<handle>.js
+    
+    The two formats differ: products.json has decimal price strings on the variants
+    and image objects, while product.js has integer prices in cents and image URL strings.
+    With catalog dedup enabled, images already used for another product are skipped
+    (see drop_catalog_duplicates).
     """
-    try:
-        if 'assets.ajio.com' in url:
-            url = re.sub(r'-\d+Wx\d+H-', '-1200Wx1500H-', url)
-        
-        
-        url = re.sub(r'(?i)(small|thumb|tiny|mobile|low|min)', 'large', url)
-        
-        url = re.sub(r'[?&](w|width|h|height)=\d+', '', url)
-        url = re.sub(r'[?&]size=\d+x\d+', '', url)
-        url = re.sub(r'[?&]quality=\d+', '', url)
-        
-        if '?' in url:
-            url = url.split('?')[0]
-            
-        return url
-    except:
-        return url
+    product_data = {'title': product.get('title') or '', 'price': None, 'images': [], 'description': '', 'rating': None}
+
+    price = None
+    variants = product.get('variants') or []
+    if variants and variants[0].get('price') is not None:
+        price = variants[0]['price']
+    elif product.get('price') is not None:
+        price = product['price']
+    if price is not None:
+        try:
+            if isinstance(price, int):
+                # product.js reports prices in cents
+                product_data['price'] = price / 100
+            else:
+                product_data['price'] = float(price)
+        except (TypeError, ValueError):
+            pass
+
+    seen = set()
+    images = []
+    for image in product.get('images') or []:
+        src = image.get('src') if isinstance(image, dict) else image
+        if not src:
+            continue
+        if src.startswith('//'):
+            src = f"https:{src}"
+        cleaned_src = clean_image_url(src)
+        if cleaned_src not in seen:
+            seen.add(cleaned_src)
+            images.append(cleaned_src)
+    product_data['images'] = drop_catalog_duplicates(images, product_url, limit=4)
+
+    body_html = product.get('body_html') or product.get('description') or ''
+    product_data['description'] = BeautifulSoup(body_html, 'html.parser').get_text(' ', strip=True) if body_html else ''
 
-def is_valid_image(image_url, min_width=200, min_height=200, max_compression_ratio=0.1):
+    return add_ad_fields(product_data, product_url)
+
+MAX_IMAGES = 4
+REQUIRED_FIELDS = ('title', 'price', 'images')
+
+ExtractionContext = namedtuple('ExtractionContext', ['page', 'product_url', 'content', 'platform'])
+
+class Extractor(namedtuple('Extractor', ['name', 'function', 'cost', 'fields', 'platforms'])):
     """
-    Checks if an image is valid based on:
-    1. Not being blank/solid color
-    2. Meeting minimum resolution requirements
-    3. Not being too pixelated/low quality
+    A registered extraction strategy. `cost` orders the pipeline (cheapest first) and
+    covers both the work the extractor does and the downstream work its results need,
+    e.g. image URLs that still have to be downloaded for validation. `fields` are the
+    product_data fields it can supply and `platforms` the store platforms it runs on
+    (None for all).
+    """
+    __slots__ = ()
+
+EXTRACTORS = []
+EXTRACTOR_STATS = {}
+_extractor_stats_lock = threading.Lock()
+
+def register_extractor(name, cost, fields, platforms=None):
+    """
+    Decorator registering a function as an extractor
     
-    Args:
-        image_url: URL of the image to check
-        min_width: Minimum acceptable width in pixels
-        min_height: Minimum acceptable height in pixels
-        max_compression_ratio: Maximum acceptable compression ratio (lower means more compressed/lower quality)
+    The function is called as function(ctx, product_data) with an ExtractionContext
+    and the data found so far, and returns a dict of the fields it found. Images are
+    appended to the ones found so far; other fields are only filled if still empty.
     """
-    try:
-        response = urlopen(image_url, timeout=5)
-        image_data = response.read()
-        
-        img = Image.open(io.BytesIO(image_data))
-        
-        width, height = img.size
-        if width < min_width or height < min_height:
-            print(f"Debug - Image rejected (too small): {width}x{height}")
-            return False
-            
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            
-        img_array = np.array(img)
-        
-        std_dev = np.std(img_array)
-        if std_dev < 10:  # Arbitrary threshold for "blankness"
-            print(f"Debug - Image rejected (blank/solid color): std_dev={std_dev}")
-            return False
-            
-        histogram = img.histogram()
-        histogram_length = sum(histogram)
-        samples_probability = [hist_value/histogram_length for hist_value in histogram]
-        entropy = -sum([p * np.log2(p) for p in samples_probability if p != 0])
-        
-        if entropy < max_compression_ratio * np.log2(256):
-            print(f"Debug - Image rejected (low quality): entropy={entropy}")
-            return False
-            
-        small = img.resize((width//4, height//4), Image.Resampling.LANCZOS)
-        large = small.resize((width, height), Image.Resampling.NEAREST)
-        diff = np.array(img) - np.array(large)
-        if np.mean(np.abs(diff)) < 5:  # Arbitrary threshold for pixelation
-            print(f"Debug - Image rejected (pixelated)")
+    def decorator(function):
+        EXTRACTORS.append(Extractor(name, function, cost, tuple(fields),
+                                    tuple(platforms) if platforms else None))
+        EXTRACTORS.sort(key=lambda extractor: extractor.cost)
+        return function
+    return decorator
+
+WOOCOMMERCE_MARKER = re.compile('woocommerce', re.I)
+
+def detect_platform(page, content):
+    """
+    Returns 'woocommerce', 'shopify' or 'generic' for a product page
+    """
+    if WOOCOMMERCE_MARKER.search(content):
+        return 'woocommerce'
+    if 'Shopify.shop' in content or any('var meta = ' in script for script in page.scripts):
+        return 'shopify'
+    return 'generic'
+
+def _record_extractor_stats(platform, name, hit, seconds):
+    with _extractor_stats_lock:
+        stats = EXTRACTOR_STATS.setdefault((platform, name), {'calls': 0, 'hits': 0, 'seconds': 0.0})
+        stats['calls'] += 1
+        stats['hits'] += int(hit)
+        stats['seconds'] += seconds
+
+def extractor_report():
+    """
+    Returns per-platform, per-extractor call counts, hit rates and mean latency
+    """
+    with _extractor_stats_lock:
+        return [{
+            'platform': platform,
+            'extractor': name,
+            'calls': stats['calls'],
+            'hit_rate': stats['hits'] / stats['calls'] if stats['calls'] else 0.0,
+            'mean_ms': stats['seconds'] * 1000 / stats['calls'] if stats['calls'] else 0.0
+        } for (platform, name), stats in sorted(EXTRACTOR_STATS.items())]
+
+def _fields_filled(product_data, fields):
+    for field in fields:
+        if field == 'images':
+            if len(product_data['images']) < MAX_IMAGES:
+                return False
+        elif not product_data.get(field):
             return False
-            
-        return True
-        
-    except Exception as e:
-        print(f"Debug - Error checking image {image_url}: {str(e)}")
-        return False
+    return True
+
+def _image_key(url):
+    # Same image regardless of scheme or query string
+    return url.split('?')[0].split('//', 1)[-1]
 
-def is_duplicate_image(new_image_url, existing_images, similarity_threshold=0.95):
+def _merge_extracted(product_data, found):
+    # Returns the fields the extractor contributed something new to
+    changed = []
+    for field, value in found.items():
+        if field == 'images':
+            seen = {_image_key(img) for img in product_data['images']}
+            for img in value:
+                if len(product_data['images']) >= MAX_IMAGES:
+                    break
+                if isinstance(img, str) and img and _image_key(img) not in seen:
+                    seen.add(_image_key(img))
+                    product_data['images'].append(img)
+                    if field not in changed:
+                        changed.append(field)
+        elif value not in (None, '') and not product_data.get(field):
+            product_data[field] = value
+            changed.append(field)
+    return changed
+
+def new_product_data():
+    return {'title': '', 'price': None, 'images': [], 'description': '', 'rating': None}
+
+def run_extractors(ctx, required=REQUIRED_FIELDS):
     """
-    Checks if an image is a duplicate of existing images by comparing content
-    
-    Args:
-        new_image_url: URL of the image to check
-        existing_images: List of existing image URLs
-        similarity_threshold: Threshold for considering images as duplicates (0-1)
+    Runs the registered extractors for the page's platform, cheapest first, until
+    every required field is filled, recording each extractor's hit rate and latency
     """
-    try:
-        response = urlopen(new_image_url, timeout=5)
-        new_img_data = response.read()
-        new_img = Image.open(io.BytesIO(new_img_data))
-        
-        new_img = new_img.convert('L').resize((32, 32))
-        new_array = np.array(new_img)
-        
-        for existing_url in existing_images:
+    product_data = new_product_data()
+    for extractor in EXTRACTORS:
+        if extractor.platforms and ctx.platform not in extractor.platforms:
+            continue
+        if _fields_filled(product_data, required):
+            break
+        if _fields_filled(product_data, extractor.fields):
+            continue
+
+        started = time.perf_counter()
+        try:
+            found = extractor.function(ctx, product_data) or {}
+        except Exception as e:
+            debug(f"Extractor {extractor.name} failed: {str(e)}")
+            found = {}
+        changed = _merge_extracted(product_data, found)
+        elapsed = time.perf_counter() - started
+        _record_extractor_stats(ctx.platform, extractor.name, bool(changed), elapsed)
+        metrics.observe(f'extract.{extractor.name}', elapsed)
+        if changed:
+            debug(f"{extractor.name} found: {', '.join(changed)}")
+
+    return product_data
+
+def _offer_price(offers):
+    if isinstance(offers, dict):
+        return float(offers.get('price', 0))
+    if isinstance(offers, list) and offers:
+        return float(offers[0].get('price', 0))
+    return None
+
+def _ld_json_objects(page):
+    for data in page.ld_json:
+        if isinstance(data, dict) and isinstance(data.get('@graph'), list):
+            yield from data['@graph']
+        yield data
+
+@register_extractor('json_ld', cost=1, fields=('title', 'price', 'images'))
+def extract_json_ld(ctx, product_data):
+    for data in _ld_json_objects(ctx.page):
+        if isinstance(data, dict) and data.get('@type') == 'Product':
+            found = {'title': data.get('name')}
             try:
-                response = urlopen(existing_url, timeout=5)
-                existing_img_data = response.read()
-                existing_img = Image.open(io.BytesIO(existing_img_data))
-                
-                existing_img = existing_img.convert('L').resize((32, 32))
-                existing_array = np.array(existing_img)
-                
-                correlation = np.corrcoef(new_array.flatten(), existing_array.flatten())[0,1]
-                if correlation > similarity_threshold:
-                    print(f"Debug - Image rejected (duplicate): similarity={correlation:.2f}")
-                    return True
-                    
-            except Exception as e:
-                print(f"Debug - Error comparing with existing image {existing_url}: {str(e)}")
+                found['price'] = _offer_price(data.get('offers'))
+            except (TypeError, ValueError):
+                pass
+            images = data.get('image', [])
+            if isinstance(images, str):
+                images = [images]
+            found['images'] = images[:MAX_IMAGES]
+            return found
+    return {}
+
+@register_extractor('opengraph', cost=1, fields=('title', 'price', 'images'))
+def extract_opengraph(ctx, product_data):
+    meta = ctx.page.meta
+    found = {'title': meta.get('og:title')}
+    for key in ('product:price:amount', 'og:price:amount'):
+        if meta.get(key):
+            try:
+                found['price'] = float(meta[key])
+                break
+            except ValueError:
                 continue
-                
-        return False
-        
-    except Exception as e:
-        print(f"Debug - Error checking duplicate {new_image_url}: {str(e)}")
+    if meta.get('og:image'):
+        found['images'] = [clean_image_url(meta['og:image'])]
+    return found
+
+@register_extractor('shopify_meta', cost=2, fields=('images',), platforms=('shopify', 'generic'))
+def extract_shopify_meta(ctx, product_data):
+    for script in ctx.page.scripts:
+        if 'var meta = ' in script:
+            json_text = script.split('var meta = ')[1].split(';\n')[0]
+            meta_data = json.loads(json_text)
+            images = []
+            for media in meta_data.get('product', {}).get('media', []):
+                if media.get('media_type') == 'image':
+                    src = media.get('src') or media.get('preview_image', {}).get('src')
+                    if src:
+                        if not src.startswith('http'):
+                            src = f"https:{src}"
+                        images.append(clean_image_url(src))
+            return {'images': images}
+    return {}
+
+@register_extractor('woocommerce', cost=2, fields=('title', 'price', 'images', 'rating', 'review_count'),
+                    platforms=('woocommerce',))
+def extract_woocommerce(ctx, product_data):
+    soup = ctx.page.soup
+    found = {}
+
+    title_element = soup.select_one('.product_title')
+    if title_element:
+        found['title'] = title_element.get_text().strip()
+    
+    price_selectors = [
+        'p.price span.woocommerce-Price-amount bdi',
+        '.price .woocommerce-Price-amount',
+        '.summary .price .woocommerce-Price-amount',
+        '[data-product-price]',
+        '.price ins .woocommerce-Price-amount',
+        '.price > .woocommerce-Price-amount'
+    ]
+    
+    for selector in price_selectors:
+        price_element = soup.select_one(selector)
+        if price_element:
+            price_text = price_element.get_text().strip()
+            try:
+                price = ''.join(c for c in price_text if c.isdigit() or c == '.')
+                if price:
+                    found['price'] = float(price)
+                    break
+            except:
+                continue
+
+    images = []
+    main_image = next(ctx.page.select_images('.woocommerce-product-gallery__image img'), None)
+    if main_image:
+        src = main_image.get('data-src') or main_image.get('src')
+        if src:
+            images.append(src)
+    
+    for img in ctx.page.select_images('.woocommerce-product-gallery__image a'):
+        src = img.get('href')
+        if src and src not in images:
+            images.append(src)
+
+    if images:
+        found['image_url'] = images[0]
+        found['images'] = images[:MAX_IMAGES]
+
+    rating_element = soup.select_one('.woocommerce-product-rating .rating')
+    review_count_element = soup.select_one('.woocommerce-review-link')
+    if rating_element and review_count_element:
+        try:
+            found['rating'] = float(rating_element.get('value', 0))
+            review_text = review_count_element.get_text()
+            review_count = ''.join(filter(str.isdigit, review_text))
+            found['review_count'] = int(review_count) if review_count else 0
+        except:
+            pass
+
+    return found
+
+@register_extractor('shopify_gallery', cost=3, fields=('images',), platforms=('shopify', 'generic'))
+def extract_shopify_gallery(ctx, product_data):
+    # Shopify theme markup is widely copied, so these also run on unknown platforms
+    images = []
+    for selector in SHOPIFY_GALLERY_SELECTORS:
+        for img in ctx.page.select_images(selector):
+            src = img.get('data-src') or img.get('data-original') or img.get('src')
+            if src:
+                if not src.startswith('http'):
+                    src = f"https:{src}"
+                images.append(clean_image_url(src))
+    return {'images': images}
+
+@register_extractor('product_script', cost=4, fields=('images',), platforms=('shopify', 'generic'))
+def extract_product_script(ctx, product_data):
+    images, seen = [], set()
+    for script in ctx.page.scripts:
+        if 'productImages' in script or 'product_images' in script:
+            for url in PRODUCT_SCRIPT_IMAGE_URL.findall(script):
+                url = clean_image_url(url)
+                if url not in seen:
+                    seen.add(url)
+                    images.append(url)
+    return {'images': images}
+
+@register_extractor('generic_selectors', cost=8, fields=('images',))
+def extract_generic_selectors(ctx, product_data):
+    # Downloads and validates candidates, unlike the extractors above
+    accepted = select_valid_images(
+        iter_generic_image_candidates(ctx.page, ctx.product_url, product_data['images']),
+        accepted=product_data['images'],
+        limit=MAX_IMAGES,
+        owner=ctx.product_url
+    )
+    return {'images': accepted[len(product_data['images']):]}
+
+@register_extractor('script_images', cost=9, fields=('images',))
+def extract_script_images(ctx, product_data):
+    # Unvalidated, low-confidence URLs: each one costs a download in the final validation pass
+    urls, base64_images = harvest_script_images(ctx.page.scripts)
+    return {'images': urls + base64_images}
+
+@register_extractor('json_ld_images', cost=10, fields=('images',))
+def extract_json_ld_images(ctx, product_data):
+    images = []
+    for json_data in _ld_json_objects(ctx.page):
+        if isinstance(json_data, dict):
+            for field in ['image', 'images', 'photo', 'photos', 'thumbnail']:
+                value = json_data.get(field)
+                if isinstance(value, str):
+                    value = [value]
+                if isinstance(value, list):
+                    images.extend(img for img in value if isinstance(img, str))
+    return {'images': images}
+
+class PageStreamReader:
+    """
+    Decodes a product page as it streams in and decides when enough of it has arrived.
+
+    Passed to HttpClient as on_chunk, it decodes each (already content-decoded) chunk
+    with an incremental text decoder and parses every complete JSON-LD block as soon
+    as its closing tag arrives. Once a JSON-LD Product fills all REQUIRED_FIELDS, the
+    extraction pipeline would stop at its first extractor anyway, so the rest of the
+    page - often megabytes of inline scripts - is not downloaded.
+    """
+
+    LD_JSON_BLOCK = re.compile(r'<script[^>]*application/ld\+json[^>]*>(.*?)</script>', re.I | re.S)
+    LD_JSON_OPEN = re.compile(r'<script[^>]*application/ld\+json', re.I)
+    META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+    def __init__(self, early_stop=True):
+        self.early_stop = early_stop
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything read so far, for when the download restarts from the first byte
+        """
+        self.ld_json = []
+        self.stopped_early = False
+        self._parts = []
+        self._pending = ''
+        self._decoder = None
+
+    def _encoding(self, response, chunk):
+        if 'charset=' in response.headers.get('Content-Type', '').lower() and response.encoding:
+            return response.encoding
+        match = self.META_CHARSET.search(chunk[:4096])
+        if match:
+            try:
+                return codecs.lookup(match.group(1).decode('ascii')).name
+            except LookupError:
+                pass
+        return 'utf-8'
+
+    def __call__(self, response, chunk):
+        if self._decoder is None:
+            self._decoder = codecs.getincrementaldecoder(self._encoding(response, chunk))(errors='replace')
+        text = self._decoder.decode(chunk)
+        self._parts.append(text)
+        if not self.early_stop:
+            return False
+
+        pending = self._pending + text
+        end = 0
+        for match in self.LD_JSON_BLOCK.finditer(pending):
+            try:
+                self.ld_json.append(json.loads(match.group(1)))
+            except ValueError:
+                pass
+            end = match.end()
+        pending = pending[end:]
+        # Keep an unfinished JSON-LD block, or just enough to catch an opening tag split across chunks
+        opening = None
+        for opening in self.LD_JSON_OPEN.finditer(pending):
+            pass
+        self._pending = pending[opening.start():] if opening else pending[-64:]
+
+        if end and self.has_required_fields():
+            self.stopped_early = True
+            return True
         return False
 
-def extract_product_data(product_url):
+    def has_required_fields(self):
+        product_data = new_product_data()
+        _merge_extracted(product_data, extract_json_ld(ExtractionContext(self, None, None, None), product_data))
+        return _fields_filled(product_data, REQUIRED_FIELDS)
+
+    @property
+    def started(self):
+        return self._decoder is not None
+
+    @property
+    def text(self):
+        if self._decoder is None:
+            return ''
+        return ''.join(self._parts) + self._decoder.decode(b'', final=True)
+
+def extract_product_data(product_url, shopify_product=None):
     """
     Extracts product data from a public product page with more flexible selectors
+    
+    For Shopify stores the product JSON is used directly: either `shopify_product`
+    (an entry of /products.json, as streamed in batch mode) or /products/<handle>.js.
+    The HTML page is only downloaded and scraped when neither is available.
     """
+    if shopify_product is None:
+        shopify_product = fetch_shopify_product_json(product_url)
+    if shopify_product is not None:
+        product_data = product_data_from_shopify_json(shopify_product, product_url)
+        if product_data['title'] and product_data['images']:
+            debug(f"Extracted product data from Shopify JSON: {len(product_data['images'])} images")
+            return product_data
+
     try:
         user_agents = [
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -176,522 +2312,585 @@ def extract_product_data(product_url):
             'Pragma': 'no-cache'
         }
         
-        session = requests.Session()
+        # requests undoes the gzip/deflate transfer encoding while streaming; the reader
+        # decodes the text as it arrives and ends the download once the product is known
+        reader = PageStreamReader()
+        response = fetch_url(product_url, 'page', headers=headers, timeout=10, retries=2, on_chunk=reader)
+        if not reader.started:
+            # Served from the disk cache: decode it like a downloaded page
+            reader.early_stop = False
+            reader(response, response.content)
+        content = reader.text
         
-        for attempt in range(3):
-            try:
-                headers['User-Agent'] = random.choice(user_agents)
-                response = requests.get(product_url, headers=headers, timeout=10)
-                response.raise_for_status()
-                
-                print("\nResponse Headers:", dict(response.headers))
-                print("Content-Type:", response.headers.get('content-type'))
-                print("Content-Encoding:", response.headers.get('content-encoding'))
-                
-                try:
-                    if response.headers.get('content-encoding') == 'gzip':
-                        import gzip
-                        content = gzip.decompress(response.content).decode('utf-8')
-                    elif response.headers.get('content-encoding') == 'deflate':
-                        import zlib
-                        content = zlib.decompress(response.content).decode('utf-8')
-                    else:
-                        content = response.text
-                except Exception as e:
-                    print(f"Warning - Decompression failed: {str(e)}, falling back to raw text")
-                    content = response.text
-                
-                print("\nResponse Status:", response.status_code)
-                print("Response Encoding:", response.encoding)
-                print("\nFirst 500 characters of decoded response:")
-                print(content[:500])
-                
-                with open('debug_response.html', 'w', encoding='utf-8') as f:
-                    f.write(content)
-                
-                soup = BeautifulSoup(content, 'html.parser')
-                product_data = {}
-                
-                for script in soup.find_all('script', {'type': 'application/ld+json'}):
-                    try:
-                        data = json.loads(script.string)
-                        print("\nDebug - Found structured data:", json.dumps(data, indent=2)[:500])
-                        
-                        if isinstance(data, dict) and data.get('@type') == 'Product':
-                            product_data['title'] = data.get('name')
-                            
-                            
-                            if 'offers' in data:
-                                offers = data['offers']
-                                if isinstance(offers, dict):
-                                    product_data['price'] = float(offers.get('price', 0))
-                                elif isinstance(offers, list) and offers:
-                                    product_data['price'] = float(offers[0].get('price', 0))
-                            
-                            images = data.get('image', [])
-                            if isinstance(images, str):
-                                images = [images]
-                            product_data['images'] = images[:4]
-                            
-                            print("\nDebug - Extracted product data from structured data:", json.dumps(product_data, indent=2))
-                            break
-                    except Exception as e:
-                        print(f"Debug - Error parsing structured data: {str(e)}")
-                        continue
-                
-                if not product_data.get('images'):
-                    og_image = soup.find('meta', {'property': 'og:image'})
-                    if og_image:
-                        product_data['images'] = [og_image.get('content')]
-                    
-                    og_title = soup.find('meta', {'property': 'og:title'})
-                    if og_title:
-                        product_data['title'] = og_title.get('content')
-                    
-                    og_price = soup.find('meta', {'property': 'product:price:amount'})
-                    if og_price:
-                        try:
-                            product_data['price'] = float(og_price.get('content', 0))
-                        except:
-                            pass
-                    
-                    print("\nDebug - Extracted product data from meta tags:", json.dumps(product_data, indent=2))
-                
-                if not product_data.get('images'):
-                    pass
-                
-                break
-                
-            except requests.exceptions.RequestException as e:
-                print(f"Attempt {attempt + 1} failed: {str(e)}")
-                if attempt == 2:  
-                    raise
-                time.sleep(1)  
+        debug(f"Response {response.status_code} for {product_url} ({len(content)} chars"
+              f"{', stopped early' if reader.stopped_early else ''}): {dict(response.headers)}")
+        
+        dump_response(product_url, content)
+        
+        with metrics.span('parse'):
+            page = PageIndex.from_html(content)
+        ctx = ExtractionContext(page, product_url, content, detect_platform(page, content))
+        product_data = run_extractors(ctx)
+
+        debug(f"Platform: {ctx.platform}")
+        debug(f"Found images: {product_data['images']}")
+        debug(f"Found price: {product_data['price']}")
+
+        product_data['images'] = list(dict.fromkeys([
+            img for img in product_data['images'] 
+            if img.startswith(('http://', 'https://', 'data:image/'))
+        ]))[:MAX_IMAGES]
+
+        add_ad_fields(product_data, product_url)
+
+        if product_data.get('images'):
+            valid_images = select_valid_images(product_data['images'], limit=None, dedupe=False,
+                                               owner=product_url)
+            
+            if not valid_images:
+                debug("No valid images found, attempting CV-based image detection...")
+                cv_images = find_images_with_cv(product_url)
+                if cv_images:
+                    product_data['images'] = cv_images
+                    debug(f"Found {len(cv_images)} images using CV")
+                else:
+                    # The unvalidated images are kept, but not ones another product already uses
+                    product_data['images'] = drop_catalog_duplicates(product_data['images'], product_url,
+                                                                     limit=None)
+            else:
+                product_data['images'] = valid_images
+
+        if not product_data.get('images'):
+            debug("Attempting CV-based image detection...")
+            cv_images = find_images_with_cv(product_url)
+            if cv_images:
+                product_data['images'] = cv_images
+                debug(f"Found {len(cv_images)} images using CV")
+
+        return product_data
+        
+    except Exception as e:
+        debug(f"Error in extract_product_data: {str(e)}")
+        raise Exception(f"Error extracting product data: {str(e)}")
+    
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+def encode_click_url(url):
+    """
+    Encodes '-' in the URL path as %2D, as ad servers expect in clickTag URLs
+    """
+    parsed_url = urlparse(url)
+    
+    path_parts = parsed_url.path.split('/')
+    encoded_path_parts = [part.replace('-', '%2D') for part in path_parts]
+    encoded_path = '/'.join(encoded_path_parts)
+    
+    encoded_url = f"{parsed_url.scheme}://{parsed_url.netloc}{encoded_path}"
+    if parsed_url.query:
+        encoded_url += f"?{parsed_url.query}"
+    if parsed_url.fragment:
+        encoded_url += f"#{parsed_url.fragment}"
+    return encoded_url
+
+def format_price(value):
+    if not value:
+        return None
+    price = f"₹{int(float(value)):,}"
+    return price.replace('$', '')
+
+class ProductRecord(namedtuple('ProductRecord', [
+        'title', 'price', 'original_price', 'images', 'product_url', 'brand_name',
+        'discount_percent', 'review_count', 'rating', 'features', 'shipping',
+        'image_url', 'description'])):
+    """
+    Immutable extraction result for one product.
+
+    A compact, hashable-by-value snapshot of product_data (lists become tuples) that
+    can be shared between threads and processes rendering different sizes or
+    templates, or cached, without anyone being able to change it underneath them.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, product_data):
+        return cls(
+            title=product_data.get('title') or '',
+            price=product_data.get('price'),
+            original_price=product_data.get('original_price'),
+            images=tuple(product_data.get('images') or ()),
+            product_url=product_data.get('product_url', ''),
+            brand_name=product_data.get('brand_name'),
+            discount_percent=product_data.get('discount_percent'),
+            review_count=product_data.get('review_count'),
+            rating=product_data.get('rating', 4.9),
+            features=tuple(product_data.get('features') or ()),
+            shipping=product_data.get('shipping'),
+            image_url=product_data.get('image_url'),
+            description=product_data.get('description') or ''
+        )
+
+    def to_dict(self):
+        product_data = self._asdict()
+        product_data['images'] = list(self.images)
+        product_data['features'] = list(self.features)
+        return dict(product_data)
+
+    def get(self, field, default=None):
+        # Lets read-only code written against product_data dicts take a record too
+        return getattr(self, field, default) if field in self._fields else default
+
+def build_view(product):
+    """
+    Derives the size-independent template variables from a product, without side effects
+    
+    Args:
+        product: ProductRecord, or a product_data dict (converted, never modified)
+    """
+    if not isinstance(product, ProductRecord):
+        product = ProductRecord.from_dict(product)
+    encoded_url = encode_click_url(product.product_url)
+    return {
+        'images': product.images,
+        'image_url': product.image_url,
+        'title': product.title,
+        'price': format_price(product.price),
+        'original_price': format_price(product.original_price),
+        'product_url': encoded_url,
+        'clickTag': encoded_url,
+        'brand_name': product.brand_name,
+        'discount_percent': product.discount_percent,
+        'review_count': product.review_count,
+        'rating': product.rating,
+        'features': product.features,
+        'shipping': product.shipping,
+        'product_data': product
+    }
+
+class AdRenderer:
+    """
+    Renders ad creatives from a template that is loaded and compiled once.
+
+    The Jinja2 environment does not re-check the template file for changes, and can
+    optionally keep compiled bytecode on disk so later runs skip compilation too.
+    render_sizes() builds the size-independent part of the template context (the
+    encoded clickTag URL, formatted prices) once and renders every size from it.
+    """
+
+    def __init__(self, template_name='ad_template.html', templates_dir=TEMPLATES_DIR, bytecode_cache_dir=None):
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        self.env = Environment(loader=FileSystemLoader(templates_dir), auto_reload=False,
+                               bytecode_cache=bytecode_cache)
+        self.template = self.env.get_template(template_name)
+        # Identifies the template source, so creatives rendered from an older version are redone
+        source, _, _ = self.env.loader.get_source(self.env, template_name)
+        self.version = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+    def build_context(self, product):
+        """
+        Returns the template variables shared by every size of a product's creative
+        """
+        return build_view(product)
+
+    def render(self, product, width, height, context=None, images=None):
+        context = context or self.build_context(product)
+        with metrics.span('render'):
+            if images is not None:
+                return self.template.render(context, width=width, height=height, images=images)
+            return self.template.render(context, width=width, height=height)
+
+    def render_sizes(self, product, sizes=None, assets=None, asset_paths=None):
+        """
+        Renders the creative in every size, returning {(width, height): html}
+        
+        Neither the product nor the renderer is modified, so several threads can
+        render from the same ProductRecord at once.
+        
+        Args:
+            assets: Optional AssetWriter; each size then references image files
+                resized for its slot instead of the original image URLs
+            asset_paths: Optional dict that receives the images each size references,
+                as {(width, height): paths}, when assets is given
+        """
+        context = self.build_context(product)
+        creatives = {}
+        for width, height in (sizes or AD_SIZES):
+            images = assets.images_for_size(context['images'], width, height) if assets else None
+            if images is not None and asset_paths is not None:
+                asset_paths[(width, height)] = images
+            creatives[(width, height)] = self.render(product, width, height, context, images)
+        return creatives
+
+TEMPLATE_BYTECODE_CACHE_DIR = None
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+def enable_template_bytecode_cache(cache_dir):
+    """
+    Keeps compiled template bytecode in cache_dir for renderers created from now on
+    """
+    global TEMPLATE_BYTECODE_CACHE_DIR
+    TEMPLATE_BYTECODE_CACHE_DIR = cache_dir
+    with _renderers_lock:
+        _renderers.clear()
+
+def get_renderer(template_name='ad_template.html'):
+    """
+    Returns the shared AdRenderer for a template, creating it on first use
+    """
+    with _renderers_lock:
+        renderer = _renderers.get(template_name)
+        if renderer is None:
+            renderer = _renderers[template_name] = AdRenderer(template_name, bytecode_cache_dir=TEMPLATE_BYTECODE_CACHE_DIR)
+        return renderer
+
+def write_creative(output_path, ad_html):
+    with metrics.span('write'):
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(ad_html)
+
+ASSETS_DIRNAME = 'assets'
+IMAGE_ASSETS_ENABLED = True
+IMAGE_ASSET_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+IMAGE_ASSET_QUALITY = 80
+
+def configure_image_assets(enabled=True, image_format=None, quality=None):
+    """
+    Configures the asset stage used by process_product
+    
+    Args:
+        enabled: Write resized image files next to the creatives; when False the
+            creatives reference the original image URLs (and CV data URIs) directly
+        image_format: 'WEBP' or 'JPEG'
+        quality: Encoder quality, 1-100
+    """
+    global IMAGE_ASSETS_ENABLED, IMAGE_ASSET_FORMAT, IMAGE_ASSET_QUALITY
+    IMAGE_ASSETS_ENABLED = enabled
+    if image_format:
+        IMAGE_ASSET_FORMAT = image_format.upper()
+    if quality:
+        IMAGE_ASSET_QUALITY = quality
+    with _asset_writers_lock:
+        _asset_writers.clear()
+
+def image_slot_size(width, height):
+    """
+    Returns the (width, height) in pixels of the image area of a creative, following
+    the layout rules of ad_template.html
+    """
+    if width == 300 and height == 250:
+        return int(width * 0.6), height
+    if width > height:
+        return int(width * 0.4), height
+    return width, int(height * 0.6)
+
+def encode_image_asset(image_data, width, height, image_format, quality):
+    """
+    Crops image_data to the aspect ratio of width x height (centred, like background-size:
+    cover), resizes it to exactly that size and encodes it as image_format
+    """
+    img = Image.open(BytesIO(image_data))
+    img.draft('RGB', (width, height))
+    if image_format == 'JPEG' or img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if image_format == 'WEBP' and 'A' in img.getbands() else 'RGB')
+    img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+    buffered = BytesIO()
+    img.save(buffered, format=image_format, quality=quality)
+    return buffered.getvalue()
+
+class AssetWriter:
+    """
+    Writes product images as resized, content-addressed files shared by all creatives.
+
+    Each source image is downloaded once through the image store and, per ad slot size,
+    cropped to cover the slot (as the template's background-size: cover would) and
+    re-encoded. Files are named after the hash of their bytes, so every creative and
+    product using the same picture at the same size points at a single file.
+    """
+
+    def __init__(self, output_dir, image_format=None, quality=None, store=None, bundle=None):
+        self.output_dir = output_dir
+        self.assets_dir = os.path.join(output_dir, ASSETS_DIRNAME)
+        self.image_format = (image_format or IMAGE_ASSET_FORMAT).upper()
+        self.quality = quality or IMAGE_ASSET_QUALITY
+        self.extension = '.webp' if self.image_format == 'WEBP' else '.jpg'
+        self.store = store or image_store
+        # CreativeBundle to write the files into instead of assets_dir
+        self.bundle = bundle
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def encode(self, image_data, width, height):
+        """
+        Returns image_data cropped and resized to width x height, encoded as image_format
+        """
+        return cpu_call(encode_image_asset, image_data, width, height, self.image_format, self.quality)
+
+    def export(self, image_url, width, height):
+        """
+        Returns the path (relative to output_dir) of image_url resized for a width x height
+        slot, writing the file if needed; returns image_url itself if it cannot be converted
+        """
+        key = (self.store.key(image_url), width, height)
+        with self._lock:
+            path = self._paths.get(key)
+        if path:
+            return path
+        try:
+            image_data = self.store.get_bytes(image_url)
+            with metrics.span('assets.encode'):
+                data = self.encode(image_data, width, height)
+        except Exception as e:
+            debug(f"Keeping original image URL, asset conversion failed: {str(e)}")
+            return image_url
+
+        filename = hashlib.sha256(data).hexdigest()[:20] + self.extension
+        file_path = os.path.join(self.assets_dir, filename)
+        if self.bundle is not None:
+            self.bundle.write(f'{ASSETS_DIRNAME}/{filename}', data)
+        elif not os.path.exists(file_path):
+            os.makedirs(self.assets_dir, exist_ok=True)
+            tmp_path = f'{file_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+
+        path = f'{ASSETS_DIRNAME}/{filename}'
+        with self._lock:
+            self._paths[key] = path
+        return path
+
+    def images_for_size(self, images, width, height):
+        """
+        Returns the asset paths to use for images in a width x height creative
+        """
+        slot_width, slot_height = image_slot_size(width, height)
+        return tuple(self.export(image_url, slot_width, slot_height) for image_url in images)
+
+_asset_writers = {}
+_asset_writers_lock = threading.Lock()
 
-        is_woocommerce = 'woocommerce' in content.lower()
+def get_asset_writer(output_dir):
+    """
+    Returns the shared AssetWriter for an output directory, creating it on first use
+    """
+    key = os.path.abspath(output_dir)
+    with _asset_writers_lock:
+        writer = _asset_writers.get(key)
+        if writer is None:
+            writer = _asset_writers[key] = AssetWriter(output_dir)
+        return writer
 
-        if is_woocommerce:
-            title_element = soup.select_one('.product_title')
-            if title_element:
-                product_data['title'] = title_element.get_text().strip()
-            
-            price_selectors = [
-                'p.price span.woocommerce-Price-amount bdi',
-                '.price .woocommerce-Price-amount',
-                '.summary .price .woocommerce-Price-amount',
-                '[data-product-price]',
-                '.price ins .woocommerce-Price-amount',
-                '.price > .woocommerce-Price-amount'
-            ]
-            
-            for selector in price_selectors:
-                price_element = soup.select_one(selector)
-                if price_element:
-                    price_text = price_element.get_text().strip()
-                    try:
-                        price = ''.join(c for c in price_text if c.isdigit() or c == '.')
-                        if price:
-                            product_data['price'] = float(price)
-                            break
-                    except:
-                        continue
+BUNDLE_FORMATS = {'zip': '.zip', 'tar.gz': '.tar.gz'}
+BUNDLE_FORMAT = None
+BUNDLE_PER_PRODUCT = False
+MINIFY_CREATIVES = False
+SHARED_DIRNAME = 'shared'
+# Inline <style>/<script> blocks at least this large are moved into shared files
+SHARED_BLOCK_MIN_BYTES = 1024
 
-            images = []
-            main_image = soup.select_one('.woocommerce-product-gallery__image img')
-            if main_image:
-                src = main_image.get('data-src') or main_image.get('src')
-                if src:
-                    images.append(src)
-            
-            gallery_images = soup.select('.woocommerce-product-gallery__image a')
-            for img in gallery_images:
-                src = img.get('href')
-                if src and src not in images:
-                    images.append(src)
-
-            if images:
-                product_data['image_url'] = images[0]
-                product_data['images'] = images[:4]  
-
-            rating_element = soup.select_one('.woocommerce-product-rating .rating')
-            review_count_element = soup.select_one('.woocommerce-review-link')
-            if rating_element and review_count_element:
-                try:
-                    product_data['rating'] = float(rating_element.get('value', 0))
-                    review_text = review_count_element.get_text()
-                    review_count = ''.join(filter(str.isdigit, review_text))
-                    product_data['review_count'] = int(review_count) if review_count else 0
-                except:
-                    pass
+def configure_bundles(bundle_format=None, per_product=False, minify=False):
+    """
+    Configures how process_product and run_batch write creatives
+    
+    Args:
+        bundle_format: 'zip' or 'tar.gz' to write creatives (with their image assets
+            and shared CSS/JS) into bundles instead of separate files; None for files
+        per_product: One bundle per product (<handle>.zip) instead of one per batch
+            (creatives.zip)
+        minify: Strip indentation, blank lines and comments from the HTML, CSS and JS
+    """
+    global BUNDLE_FORMAT, BUNDLE_PER_PRODUCT, MINIFY_CREATIVES
+    if bundle_format and bundle_format not in BUNDLE_FORMATS:
+        raise ValueError(f"Unknown bundle format: {bundle_format}")
+    BUNDLE_FORMAT = bundle_format
+    BUNDLE_PER_PRODUCT = per_product
+    MINIFY_CREATIVES = minify
+
+INLINE_BLOCK = re.compile(r'<(style|script)>(.*?)</\1>', re.S)
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE = re.compile(r'\s*([{};,])\s*|(:)\s+|\s+')
+HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+LINE_INDENT = re.compile(r'\n\s+')
+
+def minify_css(css):
+    return CSS_SPACE.sub(lambda m: m.group(1) or m.group(2) or ' ', CSS_COMMENT.sub('', css)).strip()
+
+def minify_js(js):
+    # Only whole-line changes, which cannot alter the meaning of a script that does not
+    # rely on line-leading whitespace inside template literals
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+def minify_html(html):
+    """
+    Returns html without indentation, blank lines and comments, and with the CSS and
+    JS of its inline <style>/<script> blocks minified
+    
+    Whitespace between elements is reduced to a newline rather than removed, so the
+    rendered page does not change.
+    """
+    parts = []
+    position = 0
+    for match in INLINE_BLOCK.finditer(html):
+        parts.append(LINE_INDENT.sub('\n', HTML_COMMENT.sub('', html[position:match.start()])))
+        tag, body = match.groups()
+        parts.append(f'<{tag}>{minify_css(body) if tag == "style" else minify_js(body)}</{tag}>')
+        position = match.end()
+    parts.append(LINE_INDENT.sub('\n', HTML_COMMENT.sub('', html[position:])))
+    return ''.join(parts).strip() + '\n'
+
+class CreativeBundle:
+    """
+    Streams creatives, their image assets and their shared CSS/JS into one zip or
+    tar.gz archive.
+
+    Every creative inlines the template's CSS and carousel script, which are the same
+    for all products of an ad size. write_creative() moves each large inline
+    <style>/<script> block into shared/<hash>.css or .js, written once per bundle
+    and referenced with <link>/<script src> in place, so the archive holds one copy
+    of each. Entries are compressed and appended as they are written, and the
+    archive is only moved into place by close(), so a failed run never leaves a
+    truncated bundle behind. Safe to use from several threads.
+    """
 
+    def __init__(self, path, minify=False):
+        self.path = path
+        self.minify = minify
+        self.bundle_format = next((name for name, extension in BUNDLE_FORMATS.items()
+                                   if path.endswith(extension)), None)
+        if self.bundle_format is None:
+            raise ValueError(f"Bundle path must end in one of {', '.join(BUNDLE_FORMATS.values())}: {path}")
+        self._tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if self.bundle_format == 'zip':
+            self._archive = zipfile.ZipFile(self._tmp_path, 'w', zipfile.ZIP_DEFLATED)
         else:
-            # Shopify logic
-            product_data = {'title': '', 'price': None, 'images': [], 'description': '', 'rating': None}
-            
-            for script in soup.find_all('script', type='application/ld+json'):
-                try:
-                    data = json.loads(script.string)
-                    if isinstance(data, dict) and '@type' in data and data['@type'] == 'Product':
-                        if 'offers' in data:
-                            offers = data['offers']
-                            if isinstance(offers, dict):
-                                product_data['price'] = float(offers.get('price', 0))
-                            elif isinstance(offers, list) and offers:
-                                product_data['price'] = float(offers[0].get('price', 0))
-                        break
-                except:
-                    continue
+            self._archive = tarfile.open(self._tmp_path, 'w|gz')
+        self._names = set()
+        self._lock = threading.Lock()
+        self._assets = None
 
-            if not product_data['price']:
-                price_meta = soup.find('meta', property='og:price:amount')
-                if price_meta:
-                    try:
-                        product_data['price'] = float(price_meta.get('content', 0))
-                    except:
-                        pass
-
-            for script in soup.find_all('script'):
-                if script.string and 'var meta = ' in script.string:
-                    try:
-                        json_text = script.string.split('var meta = ')[1].split(';\n')[0]
-                        meta_data = json.loads(json_text)
-                        
-                        if 'product' in meta_data:
-                            product = meta_data['product']
-                            if 'media' in product:
-                                for media in product['media']:
-                                    if media.get('media_type') == 'image':
-                                        src = media.get('src') or media.get('preview_image', {}).get('src')
-                                        if src:
-                                            if not src.startswith('http'):
-                                                src = f"https:{src}"
-                                            base_src = src.split('?')[0]
-                                            if base_src not in [img.split('?')[0] for img in product_data['images']]:
-                                                cleaned_src = clean_image_url(src)
-                                                product_data['images'].append(cleaned_src)
-                                break
-                    except Exception as e:
-                        print(f"Debug - Error parsing Shopify JSON: {str(e)}")
-                        continue
-            
-            #We will only fall back to OpenCV if all other methods are exhausted
-            if not product_data['images']:
-                og_image = soup.find('meta', property='og:image')
-                if og_image:
-                    src = og_image.get('content')
-                    if src and src not in product_data['images']:
-                        cleaned_src = clean_image_url(src)
-                        product_data['images'].append(cleaned_src)
-
-            print("\nDebug - Found images:", product_data['images'])
-            print("Debug - Found price:", product_data['price'])
-            
-            product_data['images'] = list(dict.fromkeys([img.split('?')[0] for img in product_data['images']]))[:4]
-
-            if len(product_data['images']) < 4:
-                gallery_selectors = [
-                    '.product-gallery__image img',
-                    '.product__media-item img',
-                    '.product-single__media img',
-                    '.product-single__photo img',
-                    '[data-product-media-type="image"] img',
-                    '.product__slide img',
-                    '.product-single__thumbnail img'
-                ]
-                for selector in gallery_selectors:
-                    gallery_images = soup.select(selector)
-                    for img in gallery_images:
-                        src = img.get('data-src') or img.get('data-original') or img.get('src')
-                        if src:
-                            if not src.startswith('http'):
-                                src = f"https:{src}"
-                            base_src = src.split('?')[0]
-                            if base_src not in [img.split('?')[0] for img in product_data['images']]:
-                                cleaned_src = clean_image_url(src)
-                                product_data['images'].append(cleaned_src)
-                                if len(product_data['images']) >= 4:
-                                    break
-                        if len(product_data['images']) >= 4:
-                            break
-
-                if len(product_data['images']) < 4:
-                    for script in soup.find_all('script'):
-                        if script.string and ('productImages' in script.string or 'product_images' in script.string):
-                            try:
-                                urls = re.findall(r'https?://[^\s<>"\']+?(?:jpg|jpeg|png|webp)', script.string)
-                                for url in urls:
-                                    base_url = url.split('?')[0]
-                                    if base_url not in [img.split('?')[0] for img in product_data['images']]:
-                                        cleaned_url = clean_image_url(url)
-                                        product_data['images'].append(cleaned_url)
-                                        if len(product_data['images']) >= 4:
-                                            break
-                            except:
-                                continue
-
-        if len(product_data['images']) < 4:
-            generic_image_selectors = [
-                '[id*="product"][id*="image"] img', '[class*="product"][class*="image"] img',
-                '[id*="product"][id*="photo"] img', '[class*="product"][class*="photo"] img',
-                '[id*="product"][id*="media"] img', '[class*="product"][class*="media"] img',
-                '[id*="product"] img', '[class*="product"] img',
-                
-                '[class*="gallery"] img', '[class*="slider"] img', '[class*="carousel"] img',
-                '[class*="slide"] img', '[class*="thumbnail"] img', '[class*="preview"] img',
-                '.swiper img', '.slick img', '.owl-carousel img',
-                
-                '[class*="main-image"]', '[class*="featured-image"]', '[class*="product-image"]',
-                '[class*="hero-image"]', '[class*="zoom"]', '[class*="magnify"]',
-                
-                '[class*="image-container"] img', '[class*="img-container"] img',
-                '[class*="photo-container"] img', '[class*="media-container"] img',
-                
-                '[data-image]', '[data-src]', '[data-lazy]', '[data-srcset]',
-                '[data-zoom]', '[data-zoom-image]', '[data-large]', '[data-full]',
-                '[data-slide]', '[data-thumb]', '[data-preview]',
-                
-                '[itemprop="image"]', '[property="og:image"]',
-                
-                'main img', 'article img', '.content img', '.product img',
-                '.details img', '.info img', '.description img'
-            ]
-            
-            image_attributes = [
-                'src', 'data-src', 'data-original', 'data-lazy', 'data-srcset',
-                'data-zoom-image', 'data-large', 'data-full', 'data-image',
-                'data-zoom', 'data-high-res', 'data-retina', 'srcset',
-                'data-original-src', 'data-lazy-src', 'data-master',
-                'data-thumb', 'data-slide-img', 'data-normal',
-                'data-zoom-src', 'data-large-src', 'data-big',
-                'data-super-size', 'data-xlarge', 'href'
-            ]
-
-            for selector in generic_image_selectors:
-                if len(product_data['images']) >= 4:
-                    break
-                    
-                try:
-                    
-                    
-                    images = soup.select(selector)
-                    for img in images:
-                        if len(product_data['images']) >= 4:
-                            break
-                            
-                        for attr in image_attributes:
-                            if img.get(attr):
-                                src = img[attr]
-                                
-                                if attr == 'srcset':
-                                    try:
-                                        srcset = src.split(',')[0].strip().split(' ')[0]
-                                        src = srcset
-                                    except:
-                                        continue
-                                
-                                if src:
-                                    try:
-                                        if src.startswith('//'):
-                                            src = 'https:' + src
-                                        elif src.startswith('/'):
-                                            parsed_url = urlparse(product_url)
-                                            base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-                                            src = base_url + src
-                                        elif not src.startswith(('http://', 'https://')):
-                                            parsed_url = urlparse(product_url)
-                                            base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-                                            src = f"{base_url}/{src.lstrip('/')}"
-                                            
-                                        base_src = src.split('?')[0]
-                                        if base_src not in [img.split('?')[0] for img in product_data['images']]:
-                                            if any(base_src.lower().endswith(ext) for ext in ['.jpg','.jpeg','.png','.webp','.gif']):
-                                                if is_valid_image(src) and not is_duplicate_image(src, product_data['images']):
-                                                    product_data['images'].append(src)
-                                                    break
-                                    except:
-                                        continue
-                except:
-                    continue
+    def __enter__(self):
+        return self
 
-            if len(product_data['images']) < 4:
-                for script in soup.find_all('script'):
-                    if script.string:
-                        try:
-                            urls = re.findall(r'https?://[^\s<>"\']+?(?:jpg|jpeg|png|webp|gif)', script.string)
-                            base64_images = re.findall(r'data:image/[^;]+;base64,[a-zA-Z0-9+/]+=*', script.string)
-                            
-                            for url in urls:
-                                base_url = url.split('?')[0]
-                                if base_url not in [img.split('?')[0] for img in product_data['images']]:
-                                    product_data['images'].append(url)
-                                    if len(product_data['images']) >= 4:
-                                        break
-                                    
-                            if len(product_data['images']) < 4 and base64_images:
-                                for base64_img in base64_images:
-                                    if base64_img not in product_data['images']:
-                                        product_data['images'].append(base64_img)
-                                        if len(product_data['images']) >= 4:
-                                            break
-                        except:
-                            continue
-
-            if len(product_data['images']) < 4:
-                for script in soup.find_all('script', type='application/ld+json'):
-                    try:
-                        json_data = json.loads(script.string)
-                        if isinstance(json_data, dict):
-                            image_fields = ['image', 'images', 'photo', 'photos', 'thumbnail']
-                            for field in image_fields:
-                                if field in json_data:
-                                    images = json_data[field]
-                                    if isinstance(images, str):
-                                        images = [images]
-                                    if isinstance(images, list):
-                                        for img in images:
-                                            if isinstance(img, str) and img not in product_data['images']:
-                                                product_data['images'].append(img)
-                                                if len(product_data['images']) >= 4:
-                                                    break
-                    except:
-                        continue
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
 
-            product_data['images'] = list(dict.fromkeys([
-                img for img in product_data['images'] 
-                if img.startswith(('http://', 'https://', 'data:image/'))
-            ]))[:4]
-
-        parsed_url = urlparse(product_url)
-        store_name = parsed_url.netloc.split('.')[0].upper()
-        if store_name == 'WWW':  
-            store_name = parsed_url.netloc.split('.')[1].upper()
-
-        product_data.update({
-            'brand_name': store_name,
-            'original_price': float(product_data['price']) * 1.2 if product_data.get('price') else None,
-            'discount_percent': 20,
-            'features': [
-                'Premium Quality',
-                'Limited Edition',
-                'Exclusive Design'
-            ],
-            'shipping': 'Free Shipping Available',
-            'product_url': product_url
-        })
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._names
 
-        if product_data.get('images'):
-            valid_images = []
-            for img_url in product_data['images']:
-                if img_url.startswith('data:image'):
-                    valid_images.append(img_url)
-                elif is_valid_image(img_url): 
-                    valid_images.append(img_url)
-            
-            if not valid_images:
-                print("\nDebug - No valid images found, attempting CV-based image detection...")
-                cv_images = find_images_with_cv(product_url)
-                if cv_images:
-                    product_data['images'] = cv_images
-                    print(f"\nDebug - Found {len(cv_images)} images using CV")
-            else:
-                product_data['images'] = valid_images
+    def write(self, name, data):
+        """
+        Adds a file to the bundle; a name that was already written is skipped
+        """
+        with self._lock:
+            if name in self._names:
+                return
+            self._names.add(name)
+            with metrics.span('bundle.write'):
+                if self.bundle_format == 'zip':
+                    self._archive.writestr(name, data)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    self._archive.addfile(info, BytesIO(data))
+            metrics.incr('bundle_bytes', len(data), kind='shared' if name.startswith(SHARED_DIRNAME + '/') else 'file')
 
-        if not product_data.get('images'):
-            print("\nDebug - Attempting CV-based image detection...")
-            cv_images = find_images_with_cv(product_url)
-            if cv_images:
-                product_data['images'] = cv_images
-                print(f"\nDebug - Found {len(cv_images)} images using CV")
+    def share_blocks(self, html):
+        """
+        Returns html with its large inline <style>/<script> blocks replaced by
+        references to shared files, writing those files to the bundle
+        """
+        def share(match):
+            tag, body = match.groups()
+            if len(body) < SHARED_BLOCK_MIN_BYTES:
+                return match.group(0)
+            extension = '.css' if tag == 'style' else '.js'
+            name = f'{SHARED_DIRNAME}/{hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]}{extension}'
+            self.write(name, body.strip().encode('utf-8') + b'\n')
+            if tag == 'style':
+                return f'<link rel="stylesheet" href="{name}">'
+            return f'<script src="{name}"></script>'
+        return INLINE_BLOCK.sub(share, html)
 
-        return product_data
-        
-    except Exception as e:
-        print(f"Debug - Error in extract_product_data: {str(e)}")
-        raise Exception(f"Error extracting product data: {str(e)}")
-    
-def generate_ad_creative(product_data, output_path, width=300, height=300, template_name='ad_template.html'):
+    def write_creative(self, name, html):
+        if self.minify:
+            html = minify_html(html)
+        self.write(name, self.share_blocks(html).encode('utf-8'))
+
+    def get_asset_writer(self):
+        """
+        Returns an AssetWriter that writes image assets into this bundle
+        """
+        with self._lock:
+            if self._assets is None:
+                self._assets = AssetWriter(os.path.dirname(self.path) or '.', bundle=self)
+            return self._assets
+
+    def close(self, commit=True):
+        """
+        Finishes the archive and moves it into place (or discards it if commit is False)
+        """
+        with self._lock:
+            if self._archive is None:
+                return
+            self._archive.close()
+            self._archive = None
+        if commit:
+            os.replace(self._tmp_path, self.path)
+        else:
+            os.remove(self._tmp_path)
+
+def extract_product_record(product_url, shopify_product=None):
     """
-    Generates the ad creative HTML file with option to choose template
+    Extracts a product (see extract_product_data) as an immutable ProductRecord
     """
-    env = Environment(loader=FileSystemLoader('templates'))
-    template = env.get_template(template_name)
-
-    original_price_value = product_data.get('price')
-    original_original_price_value = product_data.get('original_price')
+    return ProductRecord.from_dict(extract_product_data(product_url, shopify_product=shopify_product))
 
-    url = product_data.get('product_url', '')
-    parsed_url = urlparse(url)
-    
-    path_parts = parsed_url.path.split('/')
-    encoded_path_parts = [part.replace('-', '%2D') for part in path_parts]
-    encoded_path = '/'.join(encoded_path_parts)
+def generate_ad_creative(product_data, output_path, width=300, height=300, template_name='ad_template.html'):
+    """
+    Generates the ad creative HTML file with option to choose template
     
-    encoded_url = f"{parsed_url.scheme}://{parsed_url.netloc}{encoded_path}"
-    if parsed_url.query:
-        encoded_url += f"?{parsed_url.query}"
-    if parsed_url.fragment:
-        encoded_url += f"#{parsed_url.fragment}"
-        
-    product_data['clickTag'] = encoded_url
-    product_data['product_url'] = encoded_url  
-    if product_data.get('price'):
-        price = f"₹{int(float(original_price_value)):,}"
-        price = price.replace('$', '')
-    else:
-        price = None
-        
-    if product_data.get('original_price'):
-        original_price = f"₹{int(float(original_original_price_value)):,}"
-        original_price = original_price.replace('$', '')
-
-    else:
-        original_price = None
-    
-    product_data['price'] = original_price_value
-    product_data['original_price'] = original_original_price_value
-
-    ad_html = template.render(
-        width=width,
-        height=height,
-        images=product_data.get('images', []),
-        image_url=product_data.get('image_url'),
-        title=product_data['title'],
-        price=price,
-        original_price=original_price,
-        product_url=product_data['product_url'],
-        brand_name=product_data.get('brand_name'),
-        discount_percent=product_data.get('discount_percent'),
-        review_count=product_data.get('review_count'),
-        rating=product_data.get('rating', 4.9),
-        features=product_data.get('features'),
-        shipping=product_data.get('shipping'),
-        product_data=product_data
-    )
-
-    with open(output_path, 'w', encoding='utf-8') as file:
-        file.write(ad_html)
+    product_data may be a dict or a ProductRecord; it is not modified.
+    """
+    write_creative(output_path, get_renderer(template_name).render(product_data, width, height))
 
-def get_all_product_urls(shop_url):
-    all_product_urls = []
+def iter_shopify_products(shop_url):
+    """
+    Yields (product_url, product) for every product in a Shopify store, paging through
+    /products.json lazily
+    """
+    shop_url = shop_url.rstrip('/')
     page = 1
     
     while True:
         url = f"{shop_url}/products.json?limit=250&page={page}"
-        response = requests.get(url)
+        response = fetch_url(url, 'page', timeout=10, use_cache=False)
         products = response.json().get('products', [])
         
         if not products:
             break
             
         for product in products:
-            all_product_urls.append(f"{shop_url}/products/{product['handle']}")
-            
-            if len(all_product_urls) >= 1:
-                return all_product_urls[:1]
+            yield f"{shop_url}/products/{product['handle']}", product
                 
         page += 1
-    
-    return all_product_urls[:5]  
+
+def iter_product_urls(shop_url):
+    """
+    Yields the URL of every product in a Shopify store
+    """
+    for product_url, _ in iter_shopify_products(shop_url):
+        yield product_url
+
+def get_all_product_urls(shop_url):
+    return list(iter_product_urls(shop_url))
+
 def validate_product_data(product_data):
     """
     Validates product data and images are still accessible
@@ -702,79 +2901,813 @@ def validate_product_data(product_data):
             raise ValueError(f"Missing required field: {field}")
             
     for image_url in product_data.get('images', []):
-        response = requests.head(image_url)
+        response = http_client.head(image_url)
         if response.status_code != 200:
             raise ValueError(f"Image not accessible: {image_url}")
 
+def new_chrome_driver(page_load_timeout=20):
+    """
+    Starts a headless Chrome session configured for screenshotting product pages
+    """
+    chrome_options = Options()
+    chrome_options.add_argument('--headless')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.set_page_load_timeout(page_load_timeout)
+    driver.implicitly_wait(5)
+    return driver
+
+class BrowserPool:
+    """
+    A bounded pool of long-lived browser sessions shared by worker threads.
+
+    At most `size` browsers exist at once; a thread asking for one while all are busy
+    waits for one to be returned. A browser is quit and replaced after `max_pages`
+    pages (to cap memory growth), and whenever it fails a liveness check or raises a
+    WebDriverException, so one crashed Chrome does not take later products with it.
+    """
+
+    def __init__(self, size=2, max_pages=50, page_load_timeout=20, driver_factory=None):
+        self.size = size
+        self.max_pages = max_pages
+        self.page_load_timeout = page_load_timeout
+        self.driver_factory = driver_factory or functools.partial(new_chrome_driver, page_load_timeout)
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = deque()
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.recycled = 0
+
+    def _is_alive(self, driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _quit(self, driver):
+        with self._lock:
+            self._pages.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Returns a live browser, waiting for a free slot if the pool is exhausted
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    driver = self._idle.popleft() if self._idle else None
+                if driver is None:
+                    driver = self.driver_factory()
+                    with self._lock:
+                        self._pages[id(driver)] = 0
+                        self.started += 1
+                    return driver
+                if self._is_alive(driver):
+                    return driver
+                debug("Replacing browser that stopped responding")
+                metrics.incr('browser_restarts', reason='unresponsive')
+                self._quit(driver)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, driver, broken=False):
+        """
+        Returns a browser to the pool, quitting it if it is broken or has served max_pages
+        """
+        try:
+            with self._lock:
+                pages = self._pages.get(id(driver), 0) + 1
+                self._pages[id(driver)] = pages
+            if broken or pages >= self.max_pages:
+                if not broken:
+                    self.recycled += 1
+                self._quit(driver)
+            else:
+                with self._lock:
+                    self._idle.append(driver)
+        finally:
+            self._slots.release()
+
+    def run(self, function, retries=1):
+        """
+        Calls function(driver) with a pooled browser and returns its result
+        
+        A WebDriverException is treated as a browser crash: the browser is discarded
+        and the call is retried on a fresh one up to `retries` times.
+        """
+        for attempt in range(retries + 1):
+            driver = self.acquire()
+            try:
+                result = function(driver)
+            except WebDriverException as e:
+                self.release(driver, broken=True)
+                metrics.incr('browser_restarts', reason='crash')
+                if attempt == retries:
+                    raise
+                debug(f"Browser failed ({e.__class__.__name__}), retrying with a new one")
+                continue
+            except BaseException:
+                self.release(driver)
+                raise
+            self.release(driver)
+            return result
+
+    def load(self, driver, url):
+        """
+        Opens url in driver; a page that is still loading after page_load_timeout is
+        stopped and used as far as it got rather than failing
+        """
+        try:
+            driver.get(url)
+        except TimeoutException:
+            metrics.incr('page_load_timeouts')
+            debug(f"Page load timed out after {self.page_load_timeout}s, using partial page: {url}")
+            driver.execute_script('window.stop();')
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for driver in idle:
+            self._quit(driver)
+
+BROWSER_POOL_SIZE = 2
+browser_pool = None
+_browser_pool_lock = threading.Lock()
+
+def configure_browser_pool(size=BROWSER_POOL_SIZE, max_pages=50, page_load_timeout=20, driver_factory=None):
+    """
+    Replaces the browser pool used by the CV fallback, closing the previous one
+    """
+    global browser_pool
+    with _browser_pool_lock:
+        previous, browser_pool = browser_pool, BrowserPool(size, max_pages, page_load_timeout, driver_factory)
+    if previous:
+        previous.close()
+    return browser_pool
+
+def get_browser_pool():
+    """
+    Returns the shared browser pool, creating it (and its cleanup at exit) on first use
+    """
+    global browser_pool
+    with _browser_pool_lock:
+        if browser_pool is None:
+            browser_pool = BrowserPool(BROWSER_POOL_SIZE)
+            atexit.register(lambda: browser_pool and browser_pool.close())
+        return browser_pool
+
+CV_DETECTION_WIDTH = 640
+ImageRegion = namedtuple('ImageRegion', ['x', 'y', 'width', 'height', 'score'])
+
+def _region_overlap(a, b):
+    """
+    Returns (intersection over union, intersection over the smaller box) of two (x, y, w, h) boxes
+    """
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    if not intersection:
+        return 0.0, 0.0
+    area_a, area_b = a[2] * a[3], b[2] * b[3]
+    return intersection / float(area_a + area_b - intersection), intersection / float(min(area_a, area_b))
+
+def score_image_region(region, edges):
+    """
+    Scores how much a screenshot region looks like a product photo (higher is better)
+    
+    Photos are colourful, use many tones (high luma entropy) and have a moderate
+    amount of edges; text blocks and UI chrome are mostly one flat background colour
+    plus a few ink tones, with dense, thin edges. Larger regions with a photo-like
+    aspect ratio are preferred.
+    
+    Args:
+        region: BGR pixels of the region (on the downscaled screenshot)
+        edges: Canny edge map of the same region
+    """
+    pixels = region.reshape(-1, 3).astype(np.float32)
+    b, g, r = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    rg, yb = r - g, 0.5 * (r + g) - b
+    colourfulness = np.hypot(rg.std(), yb.std()) + 0.3 * np.hypot(rg.mean(), yb.mean())
+    luma = (0.114 * b + 0.587 * g + 0.299 * r).astype(np.uint8)
+    histogram = np.bincount(luma, minlength=256) / float(luma.size)
+    histogram = histogram[histogram > 0]
+    entropy = -np.sum(histogram * np.log2(histogram))
+    flat_fraction = histogram.max()
+    edge_density = np.count_nonzero(edges) / float(edges.size)
+    
+    height, width = edges.shape
+    aspect = max(width, height) / float(min(width, height))
+    score = (min(entropy / 7.0, 1.0) + min(colourfulness / 60.0, 1.0)) * np.sqrt(width * height)
+    score *= 1.0 - 0.8 * flat_fraction
+    if edge_density > 0.2:
+        score *= 0.2 / edge_density
+    if aspect > 2.5:
+        score *= 2.5 / aspect
+    return float(score)
+
+def detect_image_regions(img, max_regions=4, min_size=200, detection_width=CV_DETECTION_WIDTH,
+                         iou_threshold=0.3, containment_threshold=0.8):
+    """
+    Finds the regions of a page screenshot most likely to be product images
+    
+    Edges are detected on a copy downscaled to detection_width, nearby edges are
+    merged by dilation, and the outlines' bounding boxes are scored, sorted and
+    non-max suppressed (a box is dropped if it overlaps or mostly lies inside a
+    better one). Returns up to max_regions ImageRegions in full-resolution pixels.
+    
+    Args:
+        img: BGR screenshot as a numpy array
+        min_size: Minimum width and height of a region, in full-resolution pixels
+    """
+    height, width = img.shape[:2]
+    scale = min(1.0, detection_width / float(width))
+    small = img if scale == 1.0 else cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 50, 150)
+    merged = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(merged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    min_small = min_size * scale
+    candidates = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        # Undo the one pixel each side grew by in the dilation
+        x, y, w, h = x + 1, y + 1, w - 2, h - 2
+        if w >= min_small and h >= min_small:
+            score = score_image_region(small[y:y+h, x:x+w], edges[y:y+h, x:x+w])
+            candidates.append((score, (x, y, w, h)))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    
+    kept = []
+    for score, box in candidates:
+        if all(max(iou - iou_threshold, contained - containment_threshold) <= 0
+               for iou, contained in (_region_overlap(box, other) for _, other in kept)):
+            kept.append((score, box))
+            if len(kept) == max_regions:
+                break
+    
+    regions = []
+    for score, (x, y, w, h) in kept:
+        x0, y0 = int(x / scale), int(y / scale)
+        x1, y1 = min(width, int(round((x + w) / scale))), min(height, int(round((y + h) / scale)))
+        regions.append(ImageRegion(x0, y0, x1 - x0, y1 - y0, score))
+    return regions
+
+RENDERED_IMAGES_SCRIPT = """
+var images = Array.prototype.map.call(document.images, function (img) {
+    var rect = img.getBoundingClientRect();
+    return {src: img.currentSrc || img.src, x: rect.left, y: rect.top, width: rect.width,
+            height: rect.height, naturalWidth: img.naturalWidth, naturalHeight: img.naturalHeight};
+});
+return {viewportWidth: window.innerWidth, viewportHeight: window.innerHeight, images: images};
+"""
+
+def pick_rendered_images(rendered, limit=MAX_IMAGES * 2, min_size=200):
+    """
+    Picks likely product image URLs from the <img> elements of a rendered page
+    
+    Keeps http(s) images that are at least min_size pixels in their natural size,
+    shown at least half that large and at least partly inside the first viewport,
+    ordered by on-screen area (largest first), since the main product photo is
+    normally the biggest image above the fold.
+    
+    Args:
+        rendered: Result of running RENDERED_IMAGES_SCRIPT in the browser
+    """
+    viewport_width = rendered.get('viewportWidth') or 0
+    viewport_height = rendered.get('viewportHeight') or 0
+    candidates = []
+    for img in rendered.get('images') or []:
+        src = img.get('src') or ''
+        if not src.startswith(('http://', 'https://')):
+            continue
+        if (img.get('naturalWidth') or 0) < min_size or (img.get('naturalHeight') or 0) < min_size:
+            continue
+        x, y, width, height = (img.get(k) or 0 for k in ('x', 'y', 'width', 'height'))
+        if width < min_size / 2 or height < min_size / 2:
+            continue
+        visible_width = min(x + width, viewport_width) - max(x, 0)
+        visible_height = min(y + height, viewport_height) - max(y, 0)
+        if visible_width <= 0 or visible_height <= 0:
+            continue
+        candidates.append((width * height, src))
+    
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    urls, seen = [], set()
+    for _, src in candidates:
+        key = clean_image_url(src)
+        if key not in seen:
+            seen.add(key)
+            urls.append(src)
+    return urls[:limit]
+
+def screenshot_image_crops(screenshot):
+    """
+    Returns the product image regions of a page screenshot as PNG data URIs
+    """
+    nparr = np.frombuffer(screenshot, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    
+    image_urls = []
+    for region in detect_image_regions(img):
+        roi = img[region.y:region.y + region.height, region.x:region.x + region.width]
+        is_success, buffer = cv2.imencode(".png", roi)
+        if is_success:
+            img_str = base64.b64encode(buffer.tobytes()).decode()
+            image_urls.append(f"data:image/png;base64,{img_str}")
+    return image_urls
+
 def find_images_with_cv(product_url):
     """
     Uses Selenium and OpenCV to find product images on the page
+    
+    The rendered page's <img> elements are checked first (this sees lazy-loaded
+    images the static HTML did not have); the screenshot and contour detection
+    are only used if none of them is a valid product image.
     """
     try:
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.get(product_url)
-        
-        driver.implicitly_wait(5)
+        pool = get_browser_pool()
         
-        screenshot = driver.get_screenshot_as_png()
-        nparr = np.frombuffer(screenshot, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        def take_screenshot(driver):
+            pool.load(driver, product_url)
+            return driver.get_screenshot_as_png()
         
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 50, 150)
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        potential_images = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if w > 200 and h > 200:  
-                roi = img[y:y+h, x:x+w]
-
-                is_success, buffer = cv2.imencode(".png", roi)
-                if is_success:
-                    potential_images.append(BytesIO(buffer.tobytes()))
+        def read_rendered_images(driver):
+            pool.load(driver, product_url)
+            try:
+                rendered = driver.execute_script(RENDERED_IMAGES_SCRIPT)
+            except JavascriptException as e:
+                debug(f"Could not read rendered images: {str(e)}")
+                rendered = None
+            candidates = pick_rendered_images(rendered or {})
+            # Without DOM candidates, screenshot now rather than loading the page again
+            return candidates, None if candidates else driver.get_screenshot_as_png()
         
-        driver.quit()
+        with metrics.span('cv.browser'):
+            candidates, screenshot = pool.run(read_rendered_images)
+        if candidates:
+            valid_images = select_valid_images(candidates, limit=MAX_IMAGES)
+            if valid_images:
+                metrics.incr('cv_results', source='dom')
+                debug(f"Found {len(valid_images)} images in the rendered page")
+                return valid_images
+            with metrics.span('cv.browser'):
+                screenshot = pool.run(take_screenshot)
         
-        image_urls = []
-        for i, img_bytes in enumerate(potential_images[:4]): 
-            img = Image.open(img_bytes)
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            image_urls.append(f"data:image/png;base64,{img_str}")
+        with metrics.span('cv.detect'):
+            image_urls = cpu_call(screenshot_image_crops, screenshot)
         
+        metrics.incr('cv_results', source='screenshot')
         return image_urls
         
     except Exception as e:
-        print(f"Debug - Error in CV image detection: {str(e)}")
+        metrics.incr('cv_results', source='error')
+        debug(f"Error in CV image detection: {str(e)}")
         return []
 
-def main():
+AD_SIZES = [(300, 250), (300, 600), (728, 90)]
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def image_content_hash(image_url, store=None):
+    """
+    Returns the SHA-256 of an image's bytes (of the URI itself for data: URIs), or None
+    if the image cannot be fetched
+    """
+    if image_url.startswith('data:'):
+        return sha256_hex(image_url.encode('utf-8'))
+    try:
+        return (store or image_store).get_derived(image_url, 'sha256', sha256_hex)
+    except Exception as e:
+        debug(f"Could not hash image {image_url}: {str(e)}")
+        return None
+
+def product_fingerprint(product):
+    """
+    Returns a hash of everything extracted for a product, to tell whether it changed
+    """
+    return sha256_hex(json.dumps(product.to_dict(), sort_keys=True, default=str).encode('utf-8'))
+
+ProductResult = namedtuple('ProductResult', ['outputs', 'rendered', 'fetched'])
+
+def process_product(product_url, output_dir='output', sizes=AD_SIZES, shopify_product=None, manifest=None,
+                    bundle=None):
+    """
+    Extracts one product and writes its ad creative in every size
+    
+    Returns a ProductResult: the paths of the product's creatives, how many of them
+    were rendered in this call (the others were unchanged), and whether the product
+    was fetched at all.
+    
+    Args:
+        manifest: Optional Manifest of an earlier run. The product is not fetched again if
+            its Shopify updated_at is unchanged, and sizes whose inputs (product data,
+            image contents, template and asset settings) are unchanged are not rendered
+            or written again.
+        bundle: Optional CreativeBundle to write the creatives and their assets into.
+            Without one, and with bundles configured (see configure_bundles), the
+            product gets a bundle of its own, <output_dir>/<handle>.zip or .tar.gz.
+    """
+    product_handle = urlparse(product_url).path.rstrip('/').split('/')[-1]
+    if bundle is None and BUNDLE_FORMAT:
+        bundle_path = os.path.join(output_dir, product_handle + BUNDLE_FORMATS[BUNDLE_FORMAT])
+        with CreativeBundle(bundle_path, MINIFY_CREATIVES) as bundle:
+            return process_product(product_url, output_dir, sizes, shopify_product, None, bundle)
+    if bundle is not None:
+        return write_product_bundle(product_url, product_handle, bundle, sizes, shopify_product)
+    output_paths = {
+        (width, height): os.path.join(output_dir, f'{product_handle}_{width}x{height}_ad.html')
+        for width, height in sizes
+    }
+    renderer = get_renderer()
+    render_settings = {
+        'template': renderer.version,
+        'assets': f'{IMAGE_ASSET_FORMAT}:{IMAGE_ASSET_QUALITY}' if IMAGE_ASSETS_ENABLED else 'inline',
+        'minify': MINIFY_CREATIVES
+    }
+    updated_at = (shopify_product or {}).get('updated_at')
+    
+    if manifest and manifest.is_current(product_url, updated_at, render_settings, output_paths):
+        metrics.incr('products_unchanged')
+        debug(f"Unchanged since the last run: {product_url}")
+        return ProductResult(list(output_paths.values()), 0, False)
+    
+    print(f"\nProcessing: {product_url}")
+    product = extract_product_record(product_url, shopify_product=shopify_product)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    inputs = dict(render_settings, fingerprint=product_fingerprint(product),
+                  images=[image_content_hash(image_url) for image_url in product.images])
+    stale = [size for size, path in output_paths.items()
+             if not (manifest and manifest.is_current_size(product_url, inputs, size, path))]
+    
+    assets = get_asset_writer(output_dir) if IMAGE_ASSETS_ENABLED else None
+    asset_paths = {}
+    for size, ad_html in (renderer.render_sizes(product, stale, assets, asset_paths) if stale else {}).items():
+        write_creative(output_paths[size], minify_html(ad_html) if MINIFY_CREATIVES else ad_html)
+        print(f"Generated ad creative: {output_paths[size]}")
+    metrics.incr('creatives_unchanged', len(output_paths) - len(stale))
+    
+    if manifest:
+        # Images that could not be converted are referenced by their original URL
+        asset_files = {size: [os.path.join(output_dir, path) for path in paths
+                              if path.startswith(ASSETS_DIRNAME + '/')]
+                       for size, paths in asset_paths.items()}
+        manifest.update(product_url, updated_at, inputs, output_paths, asset_files)
+    return ProductResult(list(output_paths.values()), len(stale), True)
+
+def write_product_bundle(product_url, product_handle, bundle, sizes=AD_SIZES, shopify_product=None):
+    """
+    Extracts one product and writes its ad creative in every size into a CreativeBundle,
+    returning a ProductResult whose paths are <bundle path>!/<name>
+    """
+    print(f"\nProcessing: {product_url}")
+    product = extract_product_record(product_url, shopify_product=shopify_product)
+    
+    assets = bundle.get_asset_writer() if IMAGE_ASSETS_ENABLED else None
+    output_paths = []
+    for (width, height), ad_html in get_renderer().render_sizes(product, sizes, assets).items():
+        name = f'{product_handle}_{width}x{height}_ad.html'
+        bundle.write_creative(name, ad_html)
+        output_paths.append(f'{bundle.path}!/{name}')
+        print(f"Generated ad creative: {output_paths[-1]}")
+    return ProductResult(output_paths, len(output_paths), True)
+
+def read_journal(journal_path):
+    """
+    Returns the set of product URLs an interrupted batch run already finished
+    
+    A run that got through all its products ends the journal with a 'complete'
+    record; nothing is resumed after one, so the next run checks every product again.
+    """
+    done = set()
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('status') == 'done':
+                    done.add(record['url'])
+                elif record.get('status') == 'complete':
+                    done.clear()
+    except OSError:
+        pass
+    return done
+
+MANIFEST_VERSION = 2
+
+def size_key(size):
+    return '{}x{}'.format(*size)
+
+class Manifest:
+    """
+    Records what each product's creatives were generated from, for incremental runs.
+
+    Per product URL it keeps the Shopify updated_at, a fingerprint of the extracted
+    data, the content hashes of the chosen images, the template version and asset
+    settings, and the creative and image asset files written for each size. It is
+    stored as JSON (by default output/manifest.json) and written atomically by save().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.products = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.products = data.get('products') or {}
+        except (OSError, ValueError) as e:
+            if os.path.exists(path):
+                print(f"Ignoring unreadable manifest {path}: {str(e)}")
+
+    def get(self, product_url):
+        with self._lock:
+            return self.products.get(product_url)
+
+    def is_current(self, product_url, updated_at, render_settings, output_paths):
+        """
+        Returns True if a product's Shopify updated_at and the render settings match
+        the last run and all its creatives and their image assets still exist, so it
+        need not be fetched
+        """
+        entry = self.get(product_url)
+        if not entry or not updated_at or entry.get('updated_at') != updated_at:
+            return False
+        if any(entry.get(name) != value for name, value in render_settings.items()):
+            return False
+        return all(self._files_exist(entry, size, path) for size, path in output_paths.items())
+
+    def is_current_size(self, product_url, inputs, size, output_path):
+        """
+        Returns True if the creative for one size was generated from the same inputs
+        and it and its image assets are still on disk
+        """
+        entry = self.get(product_url)
+        if not entry or any(entry.get(name) != value for name, value in inputs.items()):
+            return False
+        return self._files_exist(entry, size, output_path)
+
+    @staticmethod
+    def _files_exist(entry, size, output_path):
+        if (entry.get('sizes') or {}).get(size_key(size)) != output_path or not os.path.exists(output_path):
+            return False
+        return all(os.path.exists(path) for path in (entry.get('asset_files') or {}).get(size_key(size), []))
+
+    def update(self, product_url, updated_at, inputs, output_paths, asset_files=None):
+        """
+        Records the inputs of a product's creatives, the creative written for each size
+        and the image asset files ({size: paths}) of the sizes rendered in this run
+        """
+        entry = dict(inputs, updated_at=updated_at,
+                     sizes={size_key(size): path for size, path in output_paths.items()},
+                     asset_files={size_key(size): paths for size, paths in (asset_files or {}).items()})
+        with self._lock:
+            # Keep sizes generated by earlier runs with a different size list
+            previous = self.products.get(product_url) or {}
+            if all(previous.get(name) == value for name, value in inputs.items()):
+                entry['sizes'] = dict(previous.get('sizes') or {}, **entry['sizes'])
+                entry['asset_files'] = dict(previous.get('asset_files') or {}, **entry['asset_files'])
+            self.products[product_url] = entry
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({'version': MANIFEST_VERSION, 'products': self.products}, indent=1, sort_keys=True)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+def run_batch(product_urls, output_dir='output', workers=8, per_host=4, retries=2,
+              journal_path=None, sizes=AD_SIZES, refresh=False, incremental=True):
+    """
+    Generates ad creatives for many products concurrently
+    
+    Args:
+        product_urls: Iterable of product URLs, or of (product_url, shopify_product) pairs as
+            yielded by iter_shopify_products; consumed lazily so it can be a generator
+        output_dir: Directory the creatives are written to
+        workers: Number of extraction/rendering worker threads
+        per_host: Maximum number of products processed at once per store host
+        retries: Number of extra attempts for a product that fails
+        journal_path: JSONL progress journal; if the last run using it was interrupted,
+            the products it finished are skipped, so the run resumes where it stopped
+        sizes: List of (width, height) ad sizes to render
+        refresh: Start a new journal instead of resuming an interrupted run
+        incremental: Use <output_dir>/manifest.json to skip products and creatives whose
+            inputs have not changed since the last run
+    
+    With bundles configured (see configure_bundles) the creatives go into
+    <output_dir>/creatives.zip (or .tar.gz), or one bundle per product. Bundles are
+    always written in full: the manifest is not used, and a batch bundle also starts
+    a new journal, since it replaces the previous bundle.
+    
+    Returns a dict with the number of products done, failed and skipped.
+    """
+    journal_path = journal_path or os.path.join(output_dir, 'journal.jsonl')
+    os.makedirs(os.path.dirname(journal_path) or '.', exist_ok=True)
+    bundle = None
+    if BUNDLE_FORMAT and not BUNDLE_PER_PRODUCT:
+        bundle = CreativeBundle(os.path.join(output_dir, 'creatives' + BUNDLE_FORMATS[BUNDLE_FORMAT]),
+                                MINIFY_CREATIVES)
+        refresh = True
+    done = set() if refresh else read_journal(journal_path)
+    manifest = Manifest(os.path.join(output_dir, 'manifest.json')) if incremental and not BUNDLE_FORMAT else None
+    
+    stats = {'done': 0, 'failed': 0, 'skipped': 0, 'creatives': 0, 'unchanged_products': 0,
+             'unchanged_creatives': 0}
+    stats_lock = threading.Lock()
+    host_limits = {}
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    
+    def host_limit(url):
+        host = urlparse(url).netloc
+        with stats_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(per_host)
+            return host_limits[host]
+    
+    def record(journal, entry):
+        with stats_lock:
+            stats[entry['status']] += 1
+            journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+    
+    def work(product_url, shopify_product, journal):
+        try:
+            error = None
+            for attempt in range(retries + 1):
+                try:
+                    with host_limit(product_url):
+                        result = process_product(product_url, output_dir, sizes, shopify_product, manifest, bundle)
+                    with stats_lock:
+                        stats['creatives'] += result.rendered
+                        stats['unchanged_creatives'] += len(result.outputs) - result.rendered
+                        stats['unchanged_products'] += not result.fetched
+                    record(journal, {'url': product_url, 'status': 'done', 'outputs': result.outputs})
+                    return
+                except Exception as e:
+                    error = e
+                    print(f"Attempt {attempt + 1} failed for {product_url}: {str(e)}")
+                    if attempt < retries:
+                        time.sleep(2 ** attempt + random.random())
+            record(journal, {'url': product_url, 'status': 'failed', 'error': str(error)})
+        finally:
+            in_flight.release()
+    
+    started = time.time()
+    try:
+        with open(journal_path, 'a' if done else 'w', encoding='utf-8') as journal:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for item in product_urls:
+                    product_url, shopify_product = item if isinstance(item, tuple) else (item, None)
+                    product_url = product_url.strip()
+                    if not product_url:
+                        continue
+                    if product_url in done:
+                        stats['skipped'] += 1
+                        continue
+                    done.add(product_url)
+                    in_flight.acquire()
+                    executor.submit(work, product_url, shopify_product, journal)
+            journal.write(json.dumps({'status': 'complete'}) + '\n')
+    except BaseException:
+        if bundle:
+            bundle.close(commit=False)
+        raise
+    finally:
+        if manifest:
+            manifest.save()
+    if bundle:
+        bundle.close()
+        print(f"Wrote bundle {bundle.path}")
+    
+    elapsed = time.time() - started
+    print(f"\nBatch finished in {elapsed:.1f}s: {stats['done']} done, "
+          f"{stats['failed']} failed, {stats['skipped']} skipped, "
+          f"{stats['creatives']} creatives ({stats['creatives'] / max(elapsed, 1e-9):.1f}/s)")
+    if manifest:
+        print(f"  unchanged: {stats['unchanged_products']} products not fetched, "
+              f"{stats['unchanged_creatives']} creatives not re-rendered")
+    for row in extractor_report():
+        print(f"  {row['platform']:<12} {row['extractor']:<18} calls={row['calls']:<6} "
+              f"hit_rate={row['hit_rate']:.0%} mean={row['mean_ms']:.1f}ms")
+    spans = metrics.snapshot()['spans']
+    for stage in sorted(spans, key=lambda stage: -spans[stage]['total_seconds']):
+        if not stage.startswith('extract.'):
+            span = spans[stage]
+            print(f"  {stage:<31} calls={span['count']:<6} total={span['total_seconds']:.2f}s "
+                  f"max={span['max_seconds'] * 1000:.0f}ms")
+    return stats
+
+def iter_url_file(path):
+    """
+    Yields product URLs from a text file with one URL per line
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate HTML5 ad creatives from product pages.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--store', help='Shopify store URL; every product in /products.json is processed')
+    source.add_argument('--urls-file', help='Text file with one product URL per line')
+    parser.add_argument('--output-dir', default='output', help='Directory for the generated creatives')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent worker threads')
+    parser.add_argument('--per-host', type=int,
+                        help='Maximum concurrent products per host (default: --workers with --store, else 4)')
+    parser.add_argument('--retries', type=int, default=2, help='Retries per failed product')
+    parser.add_argument('--host-rate', type=float,
+                        help='Maximum requests per second to any one host (default: adapt to 429/503 responses only)')
+    parser.add_argument('--journal', help='Progress journal used to resume a run (default: <output-dir>/journal.jsonl)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Check every product again instead of resuming an interrupted run')
+    parser.add_argument('--full', action='store_true',
+                        help='Regenerate every creative, even if its inputs are unchanged since the last run')
+    parser.add_argument('--catalog-dedup', action='store_true',
+                        help='Skip images that duplicate one already used for another product')
+    parser.add_argument('--template-cache-dir',
+                        help='Directory for compiled template bytecode, reused across runs')
+    parser.add_argument('--cpu-workers', type=int, default=0,
+                        help='Worker processes for image decoding, scoring and CV (0: use the worker threads)')
+    parser.add_argument('--browsers', type=int, default=BROWSER_POOL_SIZE,
+                        help='Maximum headless browsers kept open for the OpenCV fallback')
+    parser.add_argument('--bundle', choices=sorted(BUNDLE_FORMATS),
+                        help='Write the creatives, image assets and shared CSS/JS into one archive per batch')
+    parser.add_argument('--bundle-per-product', action='store_true',
+                        help='With --bundle, write one archive per product instead')
+    parser.add_argument('--minify', action='store_true', help='Minify the creatives\' HTML, CSS and JS')
+    parser.add_argument('--inline-images', action='store_true',
+                        help='Reference the original image URLs instead of writing resized image assets')
+    parser.add_argument('--metrics-out',
+                        help='Write stage timings and counters to this file (.prom for Prometheus text, else JSON)')
+    parser.add_argument('--debug', action='store_true', default=DEBUG_LOGGING,
+                        help='Print debug logging (also enabled by AD_TOOL_DEBUG=1)')
+    parser.add_argument('--debug-dump-dir', help='Save every downloaded product page to this directory')
+    parser.add_argument('--cache-dir', default=os.environ.get('AD_TOOL_CACHE_DIR'),
+                        help='Directory for the persistent page/image cache')
+    return parser.parse_args(argv)
+
+def main(argv=None):
     try:
+        args = parse_args(argv)
+        if args.debug or args.debug_dump_dir:
+            enable_debug(args.debug_dump_dir)
+        if args.metrics_out:
+            atexit.register(metrics.write, args.metrics_out)
+        if args.host_rate:
+            configure_http(host_rate=args.host_rate)
+        if args.cache_dir:
+            enable_disk_cache(args.cache_dir)
+        if args.catalog_dedup:
+            enable_catalog_dedup()
+        if args.template_cache_dir:
+            enable_template_bytecode_cache(args.template_cache_dir)
+        if args.cpu_workers:
+            enable_cpu_pool(args.cpu_workers)
+        if args.browsers != BROWSER_POOL_SIZE:
+            configure_browser_pool(size=args.browsers)
+        if args.inline_images:
+            configure_image_assets(enabled=False)
+        if args.bundle or args.minify:
+            configure_bundles(args.bundle, per_product=args.bundle_per_product or not (args.store or args.urls_file),
+                              minify=args.minify)
+
+        if args.store or args.urls_file:
+            product_urls = iter_shopify_products(args.store) if args.store else iter_url_file(args.urls_file)
+            # A store run has a single host; the HTTP scheduler still paces its requests
+            per_host = args.per_host or (args.workers if args.store else 4)
+            run_batch(product_urls, output_dir=args.output_dir, workers=args.workers,
+                      per_host=per_host, retries=args.retries, journal_path=args.journal,
+                      refresh=args.refresh or args.full, incremental=not args.full)
+            return
+
         product_url = input("Enter the Shopify product URL: ").strip()
         if not product_url:
             raise ValueError("Product URL cannot be empty")
             
         try:
-            print(f"\nProcessing: {product_url}")
-            product_data = extract_product_data(product_url)
-            
-            output_dir = 'output'
-            os.makedirs(output_dir, exist_ok=True)
-            
-            product_handle = urlparse(product_url).path.split('/')[-1]
-            
-            for width, height in [(300, 250), (300, 600), (728, 90)]:
-                size_output_path = os.path.join(output_dir, f'{product_handle}_{width}x{height}_ad.html')
-                generate_ad_creative(product_data, size_output_path, width, height)
-                print(f"Generated ad creative: {size_output_path}")
-                
+            process_product(product_url, args.output_dir)
         except Exception as e:
             print(f"Error processing {product_url}: {str(e)}")
                 